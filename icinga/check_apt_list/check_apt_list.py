@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+#
+# Icinga/Nagios check script reporting available upgrades, with the list of packages needing upgrade.
+# Intended for Debian-based systems.
+#
+# A drop-in replacement for the standard check_apt followed by `apt list --upgradable`: takes check_apt's
+# options and prints the same status line, followed by the same listing. Both come from a single simulated
+# apt-get upgrade, whose result is cached in /var/cache/check_apt_list and reused as long as the dpkg status,
+# the package lists and the apt preferences are unchanged (by mtime and size), so most runs do not call apt.
+# The cache directory has to be created for the check's user (e.g. nagios) unless the check runs as root;
+# without it, or if it or the cache file could be written by other users, apt-get runs every time.
+#
+# Requires Python 3
+# Version 2.0
+#
+# Copyright (c) 2018 Alexander Kashev
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Icinga check for available package upgrades on Debian/Ubuntu"""
+
+import argparse
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+
+CACHE_FILE = "/var/cache/check_apt_list/result.json"
+APT_GET = "/usr/bin/apt-get"
+UPGRADE_OPTS = "-o 'Debug::NoLocking=true' -s -qq"
+UPDATE_OPTS = "-q"
+TIMEOUT = 10
+
+# What apt's result depends on; directories stand for all files in them
+DPKG_STATUS = "/var/lib/dpkg/status"
+APT_LISTS = "/var/lib/apt/lists"
+FINGERPRINT_PATHS = [DPKG_STATUS, APT_LISTS, "/etc/apt/preferences", "/etc/apt/preferences.d"]
+
+# As in check_apt
+SECURITY_RE = r"^[^\(]*\(.* (Debian-Security:|Ubuntu:[^/]*/[^-]*-security)"
+PACKAGES_WARNING = 1
+
+# Inst <name> [<installed version>] (<version> <origin>:<release>/<suite>[, ...] [<arch>])
+INST_RE = re.compile(r"^Inst (\S+) (?:\[(\S+)\] )?\((\S+) (.*) \[(\S+)\]\)")
+
+STATES = ["OK", "WARNING", "CRITICAL", "UNKNOWN"]
+OK, WARNING, CRITICAL, UNKNOWN = range(4)
+# check_apt's ranking of states, where anything beats UNKNOWN
+SEVERITY = [UNKNOWN, OK, WARNING, CRITICAL]
+
+
+def max_state(a, b):
+    return max(a, b, key=SEVERITY.index)
+
+
+def apt_state(result):
+    # Returns (state, stderr warning, exec warning) of an apt-get run
+    state = UNKNOWN if result["status"] else OK
+    if result["stderr"]:
+        state = max_state(state, WARNING)
+    return (state, bool(result["stderr"]), bool(result["status"]))
+
+
+def fingerprint(paths):
+    entries = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            entries.append([path, -1, -1])
+            continue
+        entries.append([path, stat.st_mtime_ns, stat.st_size])
+        if os.path.isdir(path):
+            for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                # Downloads in progress and the lock do not count until they land
+                if entry.is_file() and entry.name != "lock":
+                    stat = entry.stat()
+                    entries.append([entry.path, stat.st_mtime_ns, stat.st_size])
+    return entries
+
+
+def trusted(stat):
+    # Only the check's own user or root may have written it, or anyone could fake "no upgrades"
+    return stat.st_uid in (0, os.geteuid()) and not stat.st_mode & 0o022
+
+
+def read_cache(path, key):
+    try:
+        if not trusted(os.stat(os.path.dirname(path) or ".")):
+            return None
+        with os.fdopen(os.open(path, os.O_RDONLY | os.O_NOFOLLOW)) as cache_file:
+            if not trusted(os.fstat(cache_file.fileno())):
+                return None
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    if cache.get("key") != key:
+        return None
+    return cache["result"]
+
+
+def write_cache(path, key, result):
+    directory = os.path.dirname(path) or "."
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        if not trusted(os.stat(directory)):
+            return
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o644)
+        with os.fdopen(fd, "w") as tmp:
+            json.dump({"key": key, "result": result}, tmp)
+        os.rename(tmp_path, path)
+    except OSError:
+        pass
+
+
+def run_apt(command, timeout):
+    # Returns {"status", "lines", "stderr"}, keeping only the Inst lines of the output
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                             timeout=timeout)
+    return {
+        "status": process.returncode,
+        "lines": [line for line in process.stdout.splitlines() if line.startswith("Inst ")],
+        "stderr": process.stderr,
+    }
+
+
+def simulate(command, timeout, cache_path):
+    key = {"command": command, "fingerprint": fingerprint(FINGERPRINT_PATHS)}
+    result = read_cache(cache_path, key)
+    if result is None:
+        result = run_apt(command, timeout)
+        # A failure may well be temporary
+        if result["status"] == 0:
+            write_cache(cache_path, key, result)
+    return result
+
+
+def compile_any(patterns):
+    return re.compile("|".join("({})".format(pattern) for pattern in patterns))
+
+
+def classify(lines, include, exclude, critical):
+    # Splits the Inst lines check_apt would count into (security, other) package names
+    (security, other) = ([], [])
+    for line in lines:
+        if include and not include.search(line):
+            continue
+        if exclude and exclude.search(line):
+            continue
+        name = line.split()[1]
+        (security if critical.search(line) else other).append(name)
+    return (security, other)
+
+
+def upgradable(lines):
+    # The lines of `apt list --upgradable`: upgrades of installed packages, by name
+    listing = []
+    for line in lines:
+        match = INST_RE.match(line)
+        if not match or not match.group(2):
+            continue
+        (name, installed, version, origins, arch) = match.groups()
+        suites = [origin.strip().partition("/")[2] or origin.strip() for origin in origins.split(",")]
+        listing.append((name.split(":")[0], arch, "{}/{} {} {} [upgradable from: {}]".format(
+            name.split(":")[0], ",".join(suites), version, arch, installed
+        )))
+    return [line for (_, _, line) in sorted(listing)]
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument('-U', '--upgrade', nargs='?', const=UPGRADE_OPTS, metavar='OPTS',
+                      help='simulate apt-get upgrade (the default), with these options')
+    argp.add_argument('-d', '--dist-upgrade', nargs='?', const=UPGRADE_OPTS, metavar='OPTS',
+                      help='simulate apt-get dist-upgrade instead, with these options')
+    argp.add_argument('-n', '--no-upgrade', action='store_true', help='only run apt-get update')
+    argp.add_argument('-u', '--update', nargs='?', const=UPDATE_OPTS, metavar='OPTS',
+                      help='run apt-get update first, with these options')
+    argp.add_argument('-i', '--include', action='append', default=[], metavar='REGEXP',
+                      help='only count packages whose line matches; can be repeated')
+    argp.add_argument('-e', '--exclude', action='append', default=[], metavar='REGEXP',
+                      help='do not count packages whose line matches; can be repeated')
+    argp.add_argument('-c', '--critical', action='append', default=[], metavar='REGEXP',
+                      help='packages to count as critical updates (default: security updates); can be repeated')
+    argp.add_argument('-o', '--only-critical', action='store_true', help='only warn about critical updates')
+    argp.add_argument('-w', '--packages-warning', type=int, default=PACKAGES_WARNING, metavar='N',
+                      help='warn from this many non-critical updates (default: {})'.format(PACKAGES_WARNING))
+    argp.add_argument('-l', '--list', action='store_true', help='list the counted packages, as check_apt does')
+    argp.add_argument('-t', '--timeout', type=int, default=TIMEOUT, help='seconds apt-get may take')
+    argp.add_argument('--apt-get', default=APT_GET, metavar='COMMAND', help='apt-get binary')
+    argp.add_argument('--cache', default=CACHE_FILE, metavar='FILE', help='where to cache the apt-get result')
+    args = argp.parse_args()
+
+    (state, stderr_warning, exec_warning) = (UNKNOWN, False, False)
+    (security, other, listing) = ([], [], [])
+    try:
+        if args.update is not None:
+            update = run_apt([args.apt_get] + shlex.split(args.update) + ["update"], args.timeout)
+            (state, stderr_warning, exec_warning) = apt_state(update)
+            if exec_warning:
+                print("'{} {} update' exited with non-zero status.".format(args.apt_get, args.update),
+                      file=sys.stderr)
+
+        if not args.no_upgrade:
+            (mode, opts) = ("dist-upgrade", args.dist_upgrade) if args.dist_upgrade else ("upgrade", args.upgrade)
+            command = [args.apt_get] + shlex.split(opts or UPGRADE_OPTS) + [mode]
+            result = simulate(command, args.timeout, args.cache)
+            (upgrade_state, upgrade_stderr, upgrade_exec) = apt_state(result)
+            if upgrade_exec:
+                print("'{}' exited with non-zero status.".format(" ".join(command)), file=sys.stderr)
+            state = max_state(state, upgrade_state)
+            stderr_warning = stderr_warning or upgrade_stderr
+            exec_warning = exec_warning or upgrade_exec
+            (security, other) = classify(
+                result["lines"],
+                compile_any(args.include) if args.include else None,
+                compile_any(args.exclude) if args.exclude else None,
+                compile_any(args.critical or [SECURITY_RE])
+            )
+            listing = upgradable(result["lines"])
+    except subprocess.TimeoutExpired:
+        print("CRITICAL - Plugin timed out after {} seconds".format(args.timeout))
+        sys.exit(CRITICAL)
+    except OSError as e:
+        print("APT UNKNOWN: Could not run {}: {}".format(args.apt_get, e))
+        sys.exit(UNKNOWN)
+
+    available = len(security) + len(other)
+    if security:
+        state = max_state(state, CRITICAL)
+    elif available >= args.packages_warning and not args.only_critical:
+        state = max_state(state, WARNING)
+
+    print("APT {}: {} packages available for {} ({} critical updates). {}{}{}{}|"
+          "available_upgrades={};;;0 critical_updates={};;;0".format(
+              STATES[state], available, "dist-upgrade" if args.dist_upgrade else "upgrade", len(security),
+              " warnings detected" if stderr_warning else "",
+              "," if stderr_warning and exec_warning else "",
+              " errors detected" if exec_warning else "",
+              "." if stderr_warning or exec_warning else "",
+              available, len(security)
+          ))
+    if args.list:
+        # As check_apt: security updates first, each group sorted
+        for name in sorted(security):
+            print("{} (security)".format(name))
+        if not args.only_critical:
+            for name in sorted(other):
+                print(name)
+
+    print("Listing...")
+    for line in listing:
+        print(line)
+    sys.exit(state)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,18 @@
 #
 # Requires Python 3 and module nagiosplugin (package python3-nagios or python3-nagiosplugin)
 # Also requires a working nvidia-smi install
-# Version 1.0
+#
+# Queries just the needed fields as CSV, falling back to the full XML dump for anything CSV doesn't provide.
+# With --collect, samples nvidia-smi once per interval into a snapshot file instead; checks given
+# --snapshot read that while it is fresh enough and only query nvidia-smi themselves when it is stale.
+#
+# With --batch, checks many hosts at once from their snapshots (files or commands) and prints the results
+# as passive check results for Icinga.
+# With --history, a fixed-size per-GPU sample history is kept (by the collector, or by the checks themselves)
+# to alert on averages, percentiles and the temperature trend over a time window rather than single samples.
+# Metrics come from a catalog (temperature, load and memory by default; also ECC errors, throttle reasons,
+# power, clocks, fan and per-process memory), extracted together in one pass over each GPU's data.
+# Version 2.0
 #
 # Copyright (c) 2019 Alexander Kashev
 #
@@ -29,91 +40,477 @@
 """Icinga check for Nvidia GPU status"""
 
 import nagiosplugin
+import nagiosplugin.output
 import argparse
+import fcntl
+import io
 import logging
+import math
+import mmap
+import os
+import shlex
+import struct
 import subprocess
+import sys
+import time
 import xml.etree.ElementTree as ET
-import re
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor, wait
 
 _log = logging.getLogger("nagiosplugin")
 
+SNAPSHOT_FILE = "/run/check_nvidia/nvidia-smi.xml"
+COLLECT_INTERVAL = 60
+# Snapshots older than this many seconds are ignored in favour of a live query
+MAX_AGE = 180
 
-class NvidiaResource(nagiosplugin.Resource):
-    def parse_temp(self, text):
-        match = re.search(r"(\d+) C", text)
-        if match:
-            return float(match.group(1))
-        else:
-            return None
+HISTORY_DIR = "/var/lib/check_nvidia"
+# One day of samples at the default collection interval
+HISTORY_CAPACITY = 1440
+HISTORY_WINDOW = 900
+HISTORY_PERCENTILE = 95
+# Shortest stretch of samples to derive a temperature trend from
+RATE_MIN_SPAN = 60
+
+BATCH_SERVICE = "nvidia"
+BATCH_WORKERS = 32
+BATCH_TIMEOUT = 10
+
+
+def query_xml(nvidia_smi):
+    return subprocess.check_output([nvidia_smi, "-q", "-x"])
+
+
+def unit_parser(unit):
+    # Parser for "<number> <unit>" elements; None for "N/A" and the like
+    suffix = " " + unit
+
+    def parse(element):
+        text = element.text if element is not None else None
+        if text is not None and text.endswith(suffix):
+            try:
+                return float(text[:-len(suffix)])
+            except ValueError:
+                pass
+        return None
+
+    return parse
+
+
+def parse_count(element):
+    text = element.text if element is not None else None
+    if text is not None and text.isdigit():
+        return float(text)
+    return None
+
+
+def parse_active(element):
+    # Number of reasons in effect, besides the GPU being idle
+    if element is None:
+        return None
+    return float(sum(
+        1 for reason in element
+        if reason.text == "Active" and not reason.tag.endswith("_gpu_idle")
+    ))
 
-    def parse_percent(self, text):
-        match = re.search(r"(\d+) %", text)
-        if match:
-            return float(match.group(1))
+
+class MetricSpec(object):
+    # One per-GPU metric of the catalog: where it is in the XML output (path below <gpu>) and in the CSV query,
+    # how to parse the element, and how to report it. Its maximum is a constant or read like the value.
+    # Repeated elements (processes) give one metric each, labelled by their item and valued by their value child.
+    def __init__(self, key, label, path, parse, context=None, uom="", scale=1, csv=None,
+                 maximum=None, max_path=None, max_csv=None, item=None, value=None, warning=None, critical=None):
+        self.key = key
+        self.label = label
+        self.path = path
+        self.parse = parse
+        self.context = context or "gpu_" + key
+        self.uom = uom
+        self.scale = scale
+        self.csv = csv
+        self.maximum = maximum
+        self.max_path = max_path
+        self.max_csv = max_csv
+        self.item = item
+        self.value = value
+        self.warning = warning
+        self.critical = critical
+
+
+MiB = 1024 * 1024
+
+CATALOG = [
+    MetricSpec("temp", "Temp", "temperature/gpu_temp", unit_parser("C"), csv="temperature.gpu"),
+    MetricSpec("load", "Load", "utilization/gpu_util", unit_parser("%"), context="gpu_util", uom="%",
+               csv="utilization.gpu", maximum=100),
+    MetricSpec("mem", "Mem", "fb_memory_usage/used", unit_parser("MiB"), uom="B", scale=MiB, csv="memory.used",
+               max_path="fb_memory_usage/total", max_csv="memory.total"),
+    MetricSpec("ecc", "ECC errors", "ecc_errors/volatile/double_bit/total", parse_count, uom="c",
+               csv="ecc.errors.uncorrected.volatile.total", critical="0"),
+    MetricSpec("ecc_corrected", "ECC corrected", "ecc_errors/volatile/single_bit/total", parse_count, uom="c",
+               csv="ecc.errors.corrected.volatile.total"),
+    MetricSpec("throttle", "Throttle reasons", "clocks_throttle_reasons", parse_active),
+    MetricSpec("power", "Power", "power_readings/power_draw", unit_parser("W"), csv="power.draw",
+               max_path="power_readings/power_limit", max_csv="power.limit"),
+    MetricSpec("clock_graphics", "Graphics clock", "clocks/graphics_clock", unit_parser("MHz"), csv="clocks.gr"),
+    MetricSpec("clock_sm", "SM clock", "clocks/sm_clock", unit_parser("MHz"), csv="clocks.sm"),
+    MetricSpec("clock_mem", "Mem clock", "clocks/mem_clock", unit_parser("MHz"), csv="clocks.mem"),
+    MetricSpec("fan", "Fan", "fan_speed", unit_parser("%"), uom="%", csv="fan.speed", maximum=100),
+    MetricSpec("process_mem", "Process {} Mem", "processes/process_info", unit_parser("MiB"), uom="B", scale=MiB,
+               item="pid", value="used_memory"),
+]
+METRICS = {spec.key: spec for spec in CATALOG}
+
+DEFAULT_METRICS = ["temp", "load", "mem"]
+# Recorded in the history
+HISTORY_METRICS = ["temp", "load", "mem"]
+
+
+def compile_plan(specs):
+    # Tree of the element paths the metrics need: {tag: ([(key, "value" or "max")], {child tag: ...})},
+    # so that each GPU's subtree is walked once for all of them
+    plan = {}
+    for spec in specs:
+        for (role, path) in [("value", spec.path), ("max", spec.max_path)]:
+            if path is None:
+                continue
+            (targets, children) = ([], plan)
+            for tag in path.split("/"):
+                (targets, children) = children.setdefault(tag, ([], {}))
+            targets.append((spec.key, role))
+    return plan
+
+
+def walk(element, plan, found):
+    for child in element:
+        node = plan.get(child.tag)
+        if node is not None:
+            for target in node[0]:
+                found.setdefault(target, []).append(child)
+            if node[1]:
+                walk(child, node[1], found)
+
+
+def gpu_values(gpu, specs, plan):
+    # Metric key -> [(item, value, maximum)] for one <gpu> element
+    found = {}
+    walk(gpu, plan, found)
+    values = {}
+    for spec in specs:
+        elements = found.get((spec.key, "value"), [])
+        maximum = spec.maximum
+        if spec.max_path is not None:
+            maximum = spec.parse(found.get((spec.key, "max"), [None])[0])
+        if spec.item is None:
+            values[spec.key] = [(None, spec.parse(elements[0] if elements else None), maximum)]
         else:
+            values[spec.key] = [
+                (element.findtext(spec.item), spec.parse(element.find(spec.value)), maximum)
+                for element in elements
+            ]
+    return values
+
+
+def xml_readings(output, specs, plan, block=1 << 13):
+    # Single pass over the document: each <gpu> is read once complete, then dropped. Fed in blocks to a pull
+    # parser rather than through iterparse, whose per-event overhead made it slower than building the whole tree.
+    readings = []
+    parser = ET.XMLPullParser(("end",))
+    for start in range(0, len(output), block):
+        parser.feed(output[start:start + block])
+        for (_, element) in parser.read_events():
+            if element.tag != "gpu":
+                continue
+            readings.append((len(readings), gpu_values(element, specs, plan)))
+            element.clear()
+    parser.close()
+    return readings
+
+
+def csv_columns(specs):
+    # Just the columns the metrics need, a small fraction of the work of the full XML dump;
+    # None if some of them are only in the XML output
+    columns = ["index"]
+    for spec in specs:
+        if spec.csv is None:
             return None
+        columns.append(spec.csv)
+        if spec.max_csv is not None:
+            columns.append(spec.max_csv)
+    return columns
 
-    def parse_MiB(self, text):
-        match = re.search(r"(\d+) MiB", text)
-        if match:
-            return float(match.group(1))
-        else:
+
+def query_csv(nvidia_smi, columns):
+    return subprocess.check_output([
+        nvidia_smi, "--query-gpu=" + ",".join(columns), "--format=csv,noheader,nounits"
+    ])
+
+
+def parse_csv(output, specs, columns):
+    readings = []
+    for line in output.decode().splitlines():
+        if not line.strip():
+            continue
+        fields = line.split(",")
+        if len(fields) != len(columns):
+            raise ValueError("Unexpected CSV line: {}".format(line))
+        try:
+            numbers = [float(field) for field in fields]
+        except ValueError:
+            # "[Not Supported]" or "[N/A]"; the XML output says more
             return None
+        values = {}
+        position = 1
+        for spec in specs:
+            value = numbers[position]
+            position += 1
+            maximum = spec.maximum
+            if spec.max_csv is not None:
+                maximum = numbers[position]
+                position += 1
+            values[spec.key] = [(None, value, maximum)]
+        readings.append((int(numbers[0]), values))
+    return readings
 
-    def probe(self):
-        metrics = []
 
+def read_snapshot(path, max_age):
+    try:
+        with open(path, "rb") as snapshot:
+            age = time.time() - os.fstat(snapshot.fileno()).st_mtime
+            if age > max_age:
+                _log.info("Snapshot is %d s old, querying nvidia-smi", age)
+                return None
+            return snapshot.read()
+    except OSError:
+        _log.info("No snapshot in %s, querying nvidia-smi", path)
+        return None
+
+
+def write_snapshot(path, output):
+    # Replaced atomically, so that checks never see a partial snapshot
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as tmp:
+        tmp.write(output)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    os.rename(tmp_path, path)
+
+
+class History(object):
+    # Fixed-size ring of (time, temperature, load, used MiB, total MiB) samples of one GPU, memory-mapped:
+    # an append writes one slot and the header, a window read touches only the samples in the window
+    HEADER = struct.Struct("<8sIII")
+    SAMPLE = struct.Struct("<dffff")
+    MAGIC = b"gpuhist1"
+
+    def __init__(self, path, capacity=HISTORY_CAPACITY):
+        self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
         try:
-            output = subprocess.check_output(["nvidia-smi", "-q", "-x"])
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            size = os.fstat(self.file.fileno()).st_size
+            header = None
+            if size >= self.HEADER.size:
+                header = self.HEADER.unpack(os.pread(self.file.fileno(), self.HEADER.size, 0))
+            if header is None or header[0] != self.MAGIC or size != self.size(header[1]):
+                # New or unusable: start afresh; an existing ring keeps its capacity
+                os.ftruncate(self.file.fileno(), self.size(capacity))
+                os.pwrite(self.file.fileno(), self.HEADER.pack(self.MAGIC, capacity, 0, 0), 0)
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+        except Exception:
+            self.file.close()
+            raise
 
-            data = ET.fromstring(output)
-            gpus = [gpu for gpu in data.findall("gpu")]
+    def size(self, capacity):
+        return self.HEADER.size + capacity * self.SAMPLE.size
 
-            temps = [
-                self.parse_temp(gpu.find("./temperature/gpu_temp").text)
-                for gpu in gpus
-            ]
+    def append(self, sample):
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            (magic, capacity, head, count) = self.HEADER.unpack_from(self.map, 0)
+            self.SAMPLE.pack_into(self.map, self.HEADER.size + head * self.SAMPLE.size, *sample)
+            self.HEADER.pack_into(self.map, 0, magic, capacity, (head + 1) % capacity, min(count + 1, capacity))
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
 
-            metrics.extend([
-                nagiosplugin.Metric("GPU {} Temp".format(idx), temp, min=0, context="gpu_temp")
-                for idx, temp in enumerate(temps)
-            ])
+    def window(self, since):
+        # Samples taken at or after since, oldest first
+        (_, capacity, head, count) = self.HEADER.unpack_from(self.map, 0)
+        samples = []
+        for age in range(count):
+            slot = (head - 1 - age) % capacity
+            sample = self.SAMPLE.unpack_from(self.map, self.HEADER.size + slot * self.SAMPLE.size)
+            if sample[0] < since:
+                break
+            samples.append(sample)
+        samples.reverse()
+        return samples
 
-            loads = [
-                self.parse_percent(gpu.find("./utilization/gpu_util").text)
-                for gpu in gpus
-            ]
+    def close(self):
+        self.map.close()
+        self.file.close()
 
-            metrics.extend([
-                nagiosplugin.Metric(
-                    "GPU {} Load".format(idx),
-                    load,
-                    "%",
-                    min=0, max=100,
-                    context="gpu_util"
-                )
-                for idx, load in enumerate(loads)
-            ])
 
-            mem_loads = [
-                (
-                    self.parse_MiB(gpu.find("./fb_memory_usage/used").text),
-                    self.parse_MiB(gpu.find("./fb_memory_usage/total").text),
-                )
-                for gpu in gpus
-            ]
+def open_history(directory, index):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return History(os.path.join(directory, "gpu{}.ring".format(index)))
 
-            metrics.extend([
-                nagiosplugin.Metric(
-                    "GPU {} Mem".format(idx),
-                    load * 1024 * 1024,
-                    "B",
-                    min=0, max=(total * 1024 * 1024),
-                    context="gpu_util"
-                )
-                for idx, (load, total) in enumerate(mem_loads)
+
+def record_history(directory, readings, timestamp):
+    def first(values, key, position):
+        entries = values.get(key)
+        if entries and entries[0][position] is not None:
+            return entries[0][position]
+        return float("nan")
+
+    for (index, values) in readings:
+        history = open_history(directory, index)
+        try:
+            history.append([
+                timestamp, first(values, "temp", 1), first(values, "load", 1),
+                first(values, "mem", 1), first(values, "mem", 2)
             ])
+        finally:
+            history.close()
+
+
+def percentile(values, percent):
+    # Nearest-rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def slope(points):
+    # Least-squares slope of (x, y) points
+    mean_x = sum(x for (x, _) in points) / len(points)
+    mean_y = sum(y for (_, y) in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for (x, _) in points)
+    if spread == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for (x, y) in points) / spread
+
+
+def collect(nvidia_smi, path, interval, history=None):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    specs = [METRICS[key] for key in HISTORY_METRICS]
+    plan = compile_plan(specs)
+    while True:
+        started = time.monotonic()
+        try:
+            output = query_xml(nvidia_smi)
+            write_snapshot(path, output)
+            if history:
+                record_history(history, xml_readings(output, specs, plan), time.time())
+        except (OSError, subprocess.CalledProcessError, ET.ParseError) as e:
+            # Keep the previous snapshot; once it goes stale, checks query nvidia-smi and report the error
+            print("Sampling failed: {}".format(e), file=sys.stderr)
+        if interval <= 0:
+            return
+        time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+class NvidiaResource(nagiosplugin.Resource):
+    def __init__(self, nvidia_smi="nvidia-smi", snapshot=None, max_age=MAX_AGE,
+                 history=None, window=HISTORY_WINDOW, percent=HISTORY_PERCENTILE, metrics=DEFAULT_METRICS):
+        self.nvidia_smi = nvidia_smi
+        self.snapshot = snapshot
+        self.max_age = max_age
+        self.history = history
+        self.window = window
+        self.percent = percent
+        # Whether the readings came from nvidia-smi just now rather than from the collector's snapshot
+        self.live = False
+
+        # Compiled once: what to report, and what to extract (including what the history records)
+        self.specs = [METRICS[key] for key in metrics]
+        self.extracted = list(self.specs)
+        if history:
+            self.extracted.extend(METRICS[key] for key in HISTORY_METRICS if key not in metrics)
+        self.plan = compile_plan(self.extracted)
+        self.columns = csv_columns(self.extracted)
+
+    def xml_readings(self, output):
+        return xml_readings(output, self.extracted, self.plan)
+
+    def readings(self):
+        # (index, {metric key: [(item, value, maximum)]}) per GPU:
+        # from a fresh snapshot, else from the CSV query if it has all the metrics, else from the full XML dump
+        if self.snapshot:
+            output = read_snapshot(self.snapshot, self.max_age)
+            if output is not None:
+                return self.xml_readings(output)
+
+        self.live = True
+        if self.columns is not None:
+            try:
+                readings = parse_csv(query_csv(self.nvidia_smi, self.columns), self.extracted, self.columns)
+                if readings is not None:
+                    return readings
+                _log.info("Some fields not available in CSV output, querying XML")
+            except (subprocess.CalledProcessError, ValueError):
+                _log.info("CSV query failed, querying XML")
+
+        return self.xml_readings(query_xml(self.nvidia_smi))
+
+    def history_metrics(self, readings):
+        # Trends over the window from the history; the collector records its samples there,
+        # a check only the ones it took itself
+        now = time.time()
+        if self.live:
+            record_history(self.history, readings, now)
+
+        metrics = []
+        for (idx, _) in readings:
+            history = open_history(self.history, idx)
+            try:
+                samples = history.window(now - self.window)
+            finally:
+                history.close()
+            temps = [(timestamp, temp) for (timestamp, temp, _, _, _) in samples if not math.isnan(temp)]
+            loads = [load for (_, _, load, _, _) in samples if not math.isnan(load)]
+
+            if temps:
+                metrics.append(nagiosplugin.Metric(
+                    "GPU {} Temp avg".format(idx), sum(temp for (_, temp) in temps) / len(temps),
+                    min=0, context="gpu_temp_avg"
+                ))
+            if len(temps) > 1 and temps[-1][0] - temps[0][0] >= RATE_MIN_SPAN:
+                # Degrees per minute
+                metrics.append(nagiosplugin.Metric(
+                    "GPU {} Temp rate".format(idx), slope(temps) * 60, context="gpu_temp_rate"
+                ))
+            if loads:
+                metrics.append(nagiosplugin.Metric(
+                    "GPU {} Load p{}".format(idx, self.percent), percentile(loads, self.percent), "%",
+                    min=0, max=100, context="gpu_util_percentile"
+                ))
+        return metrics
+
+    def probe(self):
+        metrics = []
+
+        try:
+            readings = self.readings()
+
+            if self.history:
+                metrics.extend(self.history_metrics(readings))
+
+            for spec in self.specs:
+                for (idx, values) in readings:
+                    for (item, value, maximum) in values[spec.key]:
+                        name = "GPU {} {}".format(idx, spec.label.format(item))
+                        if value is None:
+                            _log.info("%s not available", name)
+                            continue
+                        metrics.append(nagiosplugin.Metric(
+                            name,
+                            value * spec.scale,
+                            spec.uom,
+                            min=0, max=(None if maximum is None else maximum * spec.scale),
+                            context=spec.context
+                        ))
 
         except subprocess.CalledProcessError as cpe:
             _log.info("Error in nvidia-smi")
@@ -141,24 +538,162 @@ class NvidiaResource(nagiosplugin.Resource):
 
 
 class DataErrorContext(nagiosplugin.Context):
+    def __init__(self, name, state=nagiosplugin.Critical):
+        super().__init__(name)
+        self.state = state
+
     def evaluate(self, metric, resource):
-        return nagiosplugin.Result(nagiosplugin.Critical, metric.value)
+        return nagiosplugin.Result(self.state, metric.value)
 
 
 class NvidiaSummary(nagiosplugin.Summary):
     def ok(self, results):
-        def is_temp(context):
-            if context.name == 'gpu_temp':
-                return 1
-            else:
-                return 0
-
-        return "All {} GPUs healthy".format(
-            reduce(
-                lambda count, r: count + is_temp(r.context),
-                results, 0
-            )
+        # Metrics are named "GPU <index> ..."
+        return "All {} GPUs healthy".format(len(set(
+            r.metric.name.split()[1] for r in results if r.metric.name.startswith("GPU ")
+        )))
+
+
+def fetch_source(source, timeout, max_age):
+    # "!<command>" prints nvidia-smi -q -x output (e.g. over ssh); anything else is a snapshot file
+    if source.startswith("!"):
+        return subprocess.run(
+            shlex.split(source[1:]), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            timeout=timeout, check=True
+        ).stdout
+    with open(source, "rb") as snapshot:
+        age = time.time() - os.fstat(snapshot.fileno()).st_mtime
+        if age > max_age:
+            raise ValueError("Snapshot is {:.0f} s old".format(age))
+        return snapshot.read()
+
+
+class SourceResource(NvidiaResource):
+    def __init__(self, source, timeout, max_age, metrics=DEFAULT_METRICS):
+        super().__init__(max_age=max_age, metrics=metrics)
+        self.source = source
+        self.timeout = timeout
+        self.output = None
+
+    def readings(self):
+        return self.xml_readings(self.output)
+
+    def probe(self):
+        try:
+            self.output = fetch_source(self.source, self.timeout, self.max_age)
+        except subprocess.TimeoutExpired:
+            # Says nothing about the GPUs, as in batch()
+            return [nagiosplugin.Metric("source error", "Timed out", context="timeout")]
+        except subprocess.CalledProcessError as cpe:
+            return [nagiosplugin.Metric(
+                "source error", "Command exited with status {}".format(cpe.returncode), context="data_error"
+            )]
+        except (OSError, ValueError) as e:
+            return [nagiosplugin.Metric("source error", str(e), context="data_error")]
+        return super().probe()
+
+
+def make_check(resource, args):
+    check = nagiosplugin.Check(
+        resource,
+        DataErrorContext('data_error'),
+        DataErrorContext('timeout', nagiosplugin.Unknown),
+        NvidiaSummary()
+    )
+    thresholds = dict(args.threshold)
+    for spec in resource.specs:
+        if spec.key == "temp":
+            (warning, critical) = (args.warning, args.critical)
+        else:
+            (warning, critical) = thresholds.get(spec.key, (spec.warning, spec.critical))
+        check.add(nagiosplugin.ScalarContext(spec.context, warning, critical))
+    if args.history:
+        check.add(
+            nagiosplugin.ScalarContext('gpu_temp_avg', args.avg_warning, args.avg_critical),
+            nagiosplugin.ScalarContext('gpu_temp_rate', args.rate_warning, args.rate_critical),
+            nagiosplugin.ScalarContext('gpu_util_percentile', args.load_warning, args.load_critical),
         )
+    check.name = "NVIDIA"
+    return check
+
+
+def metric_list(text):
+    keys = [key.strip() for key in text.split(",") if key.strip()]
+    for key in keys:
+        if key not in METRICS:
+            raise argparse.ArgumentTypeError("unknown metric '{}', choose from {}".format(
+                key, ", ".join(spec.key for spec in CATALOG)
+            ))
+    return keys
+
+
+def threshold(text):
+    # "<metric>=<warning range>,<critical range>"; either range may be empty
+    (key, _, ranges) = text.partition("=")
+    (warning, _, critical) = ranges.partition(",")
+    if key not in METRICS:
+        raise argparse.ArgumentTypeError("unknown metric '{}'".format(key))
+    return (key, (warning or None, critical or None))
+
+
+def run_source(source, args):
+    check = make_check(SourceResource(source, args.timeout, args.max_age, args.metrics), args)
+    check()
+    output = nagiosplugin.output.Output(logging.StreamHandler(io.StringIO()))
+    output.add(check)
+    return (check.exitcode, str(output).strip())
+
+
+def batch(args):
+    # One "<host> <source>" per line; results are printed as Icinga external commands (passive check results),
+    # e.g. to be written to the icinga2.cmd pipe. A host without a source gets an UNKNOWN result of its own.
+    with open(args.batch) as hosts_file:
+        hosts = [
+            (line.split(None, 1) + [""])[:2] for line in hosts_file
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+
+    started = {}
+
+    def run(index, source):
+        started[index] = time.monotonic()
+        if not source:
+            return (nagiosplugin.Unknown.code, "NVIDIA UNKNOWN - No source given in {}".format(args.batch))
+        return run_source(source, args)
+
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+    futures = [pool.submit(run, index, source.strip()) for (index, (_, source)) in enumerate(hosts)]
+
+    # Commands are killed after the timeout, but a read from a hung file system can't be interrupted:
+    # give up on sources that have been running for longer than that, while queued ones still get their turn
+    abandoned = set()
+    pending = set(futures)
+    while pending:
+        (_, pending) = wait(pending, timeout=1)
+        now = time.monotonic()
+        for (index, future) in enumerate(futures):
+            if future in pending and now - started.get(index, now) > args.timeout + 1:
+                abandoned.add(future)
+        pending -= abandoned
+
+    timestamp = int(time.time())
+    for ((host, _), future) in zip(hosts, futures):
+        if future in abandoned:
+            (code, text) = (nagiosplugin.Unknown.code, "NVIDIA UNKNOWN - Timed out reading source")
+        else:
+            try:
+                (code, text) = future.result()
+            except Exception as e:
+                (code, text) = (nagiosplugin.Unknown.code, "NVIDIA UNKNOWN - {}: {}".format(type(e).__name__, e))
+        print("[{}] PROCESS_SERVICE_CHECK_RESULT;{};{};{};{}".format(
+            timestamp, host, args.service, code, text.replace("\n", "\\n")
+        ))
+    sys.stdout.flush()
+
+    if abandoned:
+        # Don't wait for the stuck workers at exit
+        os._exit(0)
+    pool.shutdown()
 
 
 @nagiosplugin.guarded
@@ -169,15 +704,59 @@ def main():
     argp.add_argument('-c', '--critical', metavar='RANGE', default='80',
                       help='return critical if GPU temperatureis outside RANGE')
     argp.add_argument('-v', '--verbose', action='count', default=0)
+    argp.add_argument('--nvidia-smi', metavar='COMMAND', default='nvidia-smi',
+                      help='nvidia-smi binary to run')
+    argp.add_argument('--snapshot', metavar='FILE', nargs='?', const=SNAPSHOT_FILE,
+                      help='read nvidia-smi output from a snapshot written by --collect (default {})'.format(
+                          SNAPSHOT_FILE))
+    argp.add_argument('--max-age', metavar='SECONDS', type=float, default=MAX_AGE,
+                      help='query nvidia-smi directly if the snapshot is older than SECONDS')
+    argp.add_argument('--collect', action='store_true',
+                      help='sample nvidia-smi into the snapshot file every interval instead of checking')
+    argp.add_argument('--interval', metavar='SECONDS', type=float, default=COLLECT_INTERVAL,
+                      help='sampling interval for --collect; 0 samples once and exits')
+    argp.add_argument('--batch', metavar='FILE',
+                      help='check the hosts listed in FILE and print passive check results')
+    argp.add_argument('--service', default=BATCH_SERVICE,
+                      help='service name for --batch results')
+    argp.add_argument('--workers', metavar='N', type=int, default=BATCH_WORKERS,
+                      help='sources fetched concurrently in --batch mode')
+    argp.add_argument('--timeout', metavar='SECONDS', type=float, default=BATCH_TIMEOUT,
+                      help='time limit per source in --batch mode')
+    argp.add_argument('--history', metavar='DIR', nargs='?', const=HISTORY_DIR,
+                      help='keep a per-GPU sample history in DIR (default {}) and report trends over it'.format(
+                          HISTORY_DIR))
+    argp.add_argument('--window', metavar='SECONDS', type=float, default=HISTORY_WINDOW,
+                      help='time window for the history metrics')
+    argp.add_argument('--percentile', metavar='N', type=int, default=HISTORY_PERCENTILE,
+                      help='percentile of GPU load over the window to report')
+    argp.add_argument('--avg-warning', metavar='RANGE',
+                      help='return warning if the average GPU temperature over the window is outside RANGE')
+    argp.add_argument('--avg-critical', metavar='RANGE',
+                      help='return critical if the average GPU temperature over the window is outside RANGE')
+    argp.add_argument('--rate-warning', metavar='RANGE',
+                      help='return warning if the GPU temperature trend (degrees per minute) is outside RANGE')
+    argp.add_argument('--rate-critical', metavar='RANGE',
+                      help='return critical if the GPU temperature trend (degrees per minute) is outside RANGE')
+    argp.add_argument('--load-warning', metavar='RANGE',
+                      help='return warning if the GPU load percentile over the window is outside RANGE')
+    argp.add_argument('--load-critical', metavar='RANGE',
+                      help='return critical if the GPU load percentile over the window is outside RANGE')
+    argp.add_argument('-m', '--metrics', metavar='LIST', type=metric_list, default=DEFAULT_METRICS,
+                      help='comma-separated metrics to report, from {} (default {})'.format(
+                          ", ".join(spec.key for spec in CATALOG), ",".join(DEFAULT_METRICS)))
+    argp.add_argument('-t', '--threshold', metavar='METRIC=WARN,CRIT', type=threshold, action='append', default=[],
+                      help='warning and critical ranges for a metric other than temp (use -w / -c for that)')
     args = argp.parse_args()
-    check = nagiosplugin.Check(
-        NvidiaResource(),
-        nagiosplugin.ScalarContext('gpu_temp', args.warning, args.critical),
-        nagiosplugin.ScalarContext('gpu_util'),
-        DataErrorContext('data_error'),
-        NvidiaSummary()
-    )
-    check.name = "NVIDIA"
+    if args.collect:
+        collect(args.nvidia_smi, args.snapshot or SNAPSHOT_FILE, args.interval, args.history)
+        return
+    if args.batch:
+        batch(args)
+        return
+    check = make_check(NvidiaResource(
+        args.nvidia_smi, args.snapshot, args.max_age, args.history, args.window, args.percentile, args.metrics
+    ), args)
     check.main(args.verbose)
 
 
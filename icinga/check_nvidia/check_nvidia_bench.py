@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+#
+# Benchmark for the XML extraction in check_nvidia.py: synthesises nvidia-smi -q -x documents with many GPUs
+# from sample.xml and compares the single-pass streaming extractor with the original tree-based one
+# in time and peak memory (as seen by tracemalloc), and shows the cost of extracting the whole metric catalog.
+#
+# Usage: check_nvidia_bench.py [--gpus 4,16,64] [--repeat 20] [--sample sample.xml]
+
+import os
+import re
+import sys
+import time
+import argparse
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, HERE)
+
+from check_nvidia import CATALOG, DEFAULT_METRICS, METRICS, compile_plan, xml_readings  # noqa: E402
+
+GPUS = [4, 16, 64]
+REPEAT = 20
+
+
+def synthesise(sample, count):
+    # Repeat the sample's GPUs until there are count of them, each with its own bus id
+    with open(sample, "rb") as sample_file:
+        data = ET.fromstring(sample_file.read())
+    gpus = data.findall("gpu")
+    for gpu in gpus:
+        data.remove(gpu)
+    for index in range(count):
+        gpu = ET.fromstring(ET.tostring(gpus[index % len(gpus)]))
+        gpu.set("id", "00000000:{:02X}:{:02X}.0".format(index // 32, index % 32))
+        data.append(gpu)
+    data.find("attached_gpus").text = str(count)
+    return b'<?xml version="1.0" ?>\n' + ET.tostring(data)
+
+
+def tree_readings(output):
+    # The extraction as it was: whole tree, a find() and an uncompiled regex per field
+    def parse(pattern, text):
+        match = re.search(pattern, text)
+        if match:
+            return float(match.group(1))
+        else:
+            return None
+
+    data = ET.fromstring(output)
+    gpus = [gpu for gpu in data.findall("gpu")]
+    temps = [parse(r"(\d+) C", gpu.find("./temperature/gpu_temp").text) for gpu in gpus]
+    loads = [parse(r"(\d+) %", gpu.find("./utilization/gpu_util").text) for gpu in gpus]
+    mem_loads = [
+        (
+            parse(r"(\d+) MiB", gpu.find("./fb_memory_usage/used").text),
+            parse(r"(\d+) MiB", gpu.find("./fb_memory_usage/total").text),
+        )
+        for gpu in gpus
+    ]
+    return [
+        (idx, temp, load, used, total)
+        for idx, (temp, load, (used, total)) in enumerate(zip(temps, loads, mem_loads))
+    ]
+
+
+def plan_readings(keys):
+    specs = [METRICS[key] for key in keys]
+    plan = compile_plan(specs)
+
+    def extract(output):
+        return xml_readings(output, specs, plan)
+
+    return extract
+
+
+def flat_readings(output, extract=plan_readings(DEFAULT_METRICS)):
+    # In the tree extractor's format, to check they agree
+    return [
+        (idx, values["temp"][0][1], values["load"][0][1], values["mem"][0][1], values["mem"][0][2])
+        for (idx, values) in extract(output)
+    ]
+
+
+def measure(extract, output, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        extract(output)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = extract(output)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (best, peak, result)
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Benchmark check_nvidia XML extraction")
+    argp.add_argument("--gpus", default=",".join(str(count) for count in GPUS),
+                      help="comma-separated numbers of GPUs per document")
+    argp.add_argument("--repeat", type=int, default=REPEAT, help="timing runs; the best one is reported")
+    argp.add_argument("--sample", default=os.path.join(HERE, "sample.xml"), help="nvidia-smi -q -x output")
+    args = argp.parse_args()
+
+    extractors = [("tree", tree_readings), ("streaming", flat_readings)]
+    # Not compared, as it yields more
+    all_metrics = ("all {}".format(len(CATALOG)), plan_readings([spec.key for spec in CATALOG]))
+
+    print("{:>5} {:>10} {:<10} {:>9} {:>10} {:>8}".format("GPUs", "XML KiB", "extractor", "ms", "peak KiB",
+                                                         "speedup"))
+    for count in [int(count) for count in args.gpus.split(",")]:
+        output = synthesise(args.sample, count)
+        results = [(name, measure(extract, output, args.repeat)) for (name, extract) in extractors]
+        if any(result[2] != results[0][1][2] for (_, result) in results):
+            print("Extractors disagree on {} GPUs".format(count), file=sys.stderr)
+            sys.exit(1)
+        results.append((all_metrics[0], measure(all_metrics[1], output, args.repeat)))
+        for (name, (seconds, peak, _)) in results:
+            print("{:>5} {:>10.0f} {:<10} {:>9.2f} {:>10.0f} {:>7.1f}x".format(
+                count, len(output) / 1024, name, seconds * 1000, peak / 1024, results[0][1][0] / seconds
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# Stand-in for nvidia-smi when testing check_nvidia.py on machines without GPUs:
+#
+#   FAKE_NVIDIA_SMI_SAMPLE=sample2.xml check_nvidia.py --nvidia-smi ./fake_nvidia_smi.py
+#
+# Answers "-q -x" with the sample file (sample.xml next to this script by default), and
+# --query-gpu=... --format=csv,noheader,nounits with the fields check_nvidia.py asks for, taken from it.
+# FAKE_NVIDIA_SMI_DELAY adds a delay in seconds, FAKE_NVIDIA_SMI_EXIT makes it fail with that status,
+# and every invocation is appended to FAKE_NVIDIA_SMI_LOG if set.
+
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+SAMPLE = os.environ.get("FAKE_NVIDIA_SMI_SAMPLE", os.path.join(HERE, "sample.xml"))
+
+# --query-gpu field -> element of the XML output
+QUERY_FIELDS = {
+    "temperature.gpu": "./temperature/gpu_temp",
+    "utilization.gpu": "./utilization/gpu_util",
+    "memory.used": "./fb_memory_usage/used",
+    "memory.total": "./fb_memory_usage/total",
+    "ecc.errors.uncorrected.volatile.total": "./ecc_errors/volatile/double_bit/total",
+    "ecc.errors.corrected.volatile.total": "./ecc_errors/volatile/single_bit/total",
+    "power.draw": "./power_readings/power_draw",
+    "power.limit": "./power_readings/power_limit",
+    "clocks.gr": "./clocks/graphics_clock",
+    "clocks.sm": "./clocks/sm_clock",
+    "clocks.mem": "./clocks/mem_clock",
+    "fan.speed": "./fan_speed",
+}
+
+
+def query_gpu(fields):
+    with open(SAMPLE, "rb") as sample:
+        gpus = ET.fromstring(sample.read()).findall("gpu")
+    for (index, gpu) in enumerate(gpus):
+        values = []
+        for field in fields:
+            if field == "index":
+                values.append(str(index))
+            elif field in QUERY_FIELDS:
+                text = gpu.find(QUERY_FIELDS[field]).text
+                match = re.match(r"(\d+(?:\.\d+)?)", text)
+                values.append(match.group(1) if match else "[Not Supported]")
+            else:
+                print('Field "{}" is not a valid field to query.'.format(field), file=sys.stderr)
+                sys.exit(2)
+        print(", ".join(values))
+
+
+def main():
+    if "FAKE_NVIDIA_SMI_LOG" in os.environ:
+        with open(os.environ["FAKE_NVIDIA_SMI_LOG"], "a") as log:
+            log.write(" ".join(sys.argv[1:]) + "\n")
+
+    time.sleep(float(os.environ.get("FAKE_NVIDIA_SMI_DELAY", 0)))
+    status = int(os.environ.get("FAKE_NVIDIA_SMI_EXIT", 0))
+    if status:
+        print("NVIDIA-SMI has failed", file=sys.stderr)
+        sys.exit(status)
+
+    if sys.argv[1:] == ["-q", "-x"]:
+        with open(SAMPLE, "rb") as sample:
+            sys.stdout.buffer.write(sample.read())
+    elif (
+        len(sys.argv) == 3 and sys.argv[1].startswith("--query-gpu=") and
+        sys.argv[2] == "--format=csv,noheader,nounits"
+    ):
+        query_gpu(sys.argv[1][len("--query-gpu="):].split(","))
+    else:
+        print("Unsupported arguments: {}".format(" ".join(sys.argv[1:])), file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,14 @@
 # Icinga/Nagios check script to report if a reboot is needed for some updates on Debian-based systems.
 #
 # Supports Nagios conventions for warning/critical ranges of time since reboot was first required.
-# Stores state in /tmp/reboot-required.cookie
+# Stores state in the shared store of check_state.py if installed alongside, else in /tmp/reboot-required.cookie
 # Reports the list of packages that require reboot in verbose mode.
+# With --scan, also finds processes still using deleted (upgraded) libraries and executables via /proc/*/maps,
+# grouped by systemd unit; the maps of known processes are cached in /var/cache/check_reboot_required, which has
+# to be created for the check's user (e.g. nagios) unless it runs as root; without it, all maps are read every run.
 #
 # Requires Python 3 and module nagiosplugin (package python3-nagios or python3-nagiosplugin)
-# Version 1.0
+# Version 1.2
 #
 # Copyright (c) 2018 Alexander Kashev
 #
@@ -33,18 +36,193 @@
 
 import nagiosplugin
 import argparse
+import json
 import os
 import logging
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import check_state
+except ImportError:
+    check_state = None
 
 _log = logging.getLogger("nagiosplugin")
 
+# Key in the shared state store, and the cookie file used without it
+COOKIE_KEY = "reboot_required"
 COOKIE_FILE = "/tmp/reboot-required.cookie"
+# Rewritten on most runs and large, so in a file of its own rather than in the shared store
+MAPS_CACHE_FILE = "/var/cache/check_reboot_required/maps.json"
+
+PROC = "/proc"
+SCAN_WORKERS = 8
+# Cached maps are re-read after this many seconds, to notice libraries loaded later on
+MAPS_TTL = 3600
+# Mapped files that come from packages; others (/dev/shm, memfd, caches under /var, ...) are ignored
+PACKAGED_PREFIXES = ("/usr/", "/lib", "/bin/", "/sbin/", "/opt/")
+DELETED = " (deleted)"
+
+
+def read_starttime(proc_dir):
+    with open(os.path.join(proc_dir, "stat")) as stat:
+        # The command name may contain spaces and parentheses; starttime is the 22nd field
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return fields[19]
+
+
+def read_maps(proc_dir):
+    # [path, inode, deleted] for each packaged file mapped, once
+    files = {}
+    with open(os.path.join(proc_dir, "maps")) as maps:
+        for line in maps:
+            parts = line.rstrip("\n").split(None, 5)
+            if len(parts) < 6 or parts[4] == "0":
+                continue
+            path = parts[5]
+            deleted = path.endswith(DELETED)
+            if deleted:
+                path = path[:-len(DELETED)]
+            if path.startswith(PACKAGED_PREFIXES):
+                files[path] = [path, int(parts[4]), deleted or files.get(path, [0, 0, False])[2]]
+    return list(files.values())
+
+
+def read_unit(proc_dir):
+    # Innermost systemd unit of the process, from its cgroup
+    try:
+        with open(os.path.join(proc_dir, "cgroup")) as cgroup:
+            for line in cgroup:
+                (_, controllers, path) = line.rstrip("\n").split(":", 2)
+                if controllers in ("", "name=systemd"):
+                    for name in reversed(path.split("/")):
+                        if name.endswith(".service"):
+                            return name
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def trusted(stat):
+    # Only the check's own user or root may have written it, or anyone could hide processes from the scan
+    return stat.st_uid in (0, os.geteuid()) and not stat.st_mode & 0o022
+
+
+def read_maps_cache(path):
+    try:
+        if not trusted(os.stat(os.path.dirname(path) or ".")):
+            return {}
+        with os.fdopen(os.open(path, os.O_RDONLY | os.O_NOFOLLOW)) as cache_file:
+            if not trusted(os.fstat(cache_file.fileno())):
+                return {}
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_maps_cache(path, cache):
+    directory = os.path.dirname(path) or "."
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        if not trusted(os.stat(directory)):
+            return
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o644)
+        with os.fdopen(fd, "w") as tmp:
+            json.dump(cache, tmp)
+        os.rename(tmp_path, path)
+    except OSError:
+        pass
+
+
+def open_cookie(key, path):
+    if check_state is not None and check_state.usable():
+        return check_state.Cookie(key)
+    return nagiosplugin.Cookie(path)
+
+
+class MapsScanner(object):
+    # Finds processes that map packaged files which have since been deleted or replaced.
+    # Maps are read once per process (keyed by pid and start time) and cached; for cached processes,
+    # the files are checked by inode instead, each distinct file once per run.
+    def __init__(self, proc, cache, now):
+        self.proc = proc
+        self.cache = cache
+        self.now = now
+        self.inodes = {}
+
+    def current_inode(self, root, root_id, path):
+        key = (root_id, path)
+        if key not in self.inodes:
+            try:
+                self.inodes[key] = os.stat(os.path.join(root, path.lstrip("/"))).st_ino
+            except OSError:
+                self.inodes[key] = None
+        return self.inodes[key]
+
+    def scan_process(self, pid):
+        proc_dir = os.path.join(self.proc, pid)
+        try:
+            key = "{}:{}".format(pid, read_starttime(proc_dir))
+            entry = self.cache.get(key)
+            if entry is None or self.now - entry["read"] > MAPS_TTL:
+                entry = {"read": self.now, "files": read_maps(proc_dir)}
+            # Paths as the process sees them, which differs for processes in containers
+            root = os.path.join(proc_dir, "root")
+            if not os.access(root, os.R_OK | os.X_OK):
+                root = "/"
+            root_stat = os.stat(root)
+            root_id = (root_stat.st_dev, root_stat.st_ino)
+            deleted = sorted(
+                path for (path, inode, marked) in entry["files"]
+                if marked or self.current_inode(root, root_id, path) != inode
+            )
+            with open(os.path.join(proc_dir, "comm")) as comm:
+                name = comm.read().strip()
+        except (OSError, IndexError, ValueError):
+            # Gone meanwhile, or not ours to read
+            return None
+        return (key, entry, pid, name, read_unit(proc_dir), deleted)
+
+    def scan(self):
+        pids = [name for name in os.listdir(self.proc) if name.isdigit()]
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+            results = [result for result in pool.map(self.scan_process, pids) if result is not None]
+
+        # Only live processes stay in the cache
+        self.cache.clear()
+        users = {}
+        for (key, entry, pid, name, unit, deleted) in results:
+            self.cache[key] = entry
+            if deleted:
+                users.setdefault(unit or name, []).append(int(pid))
+        return users
 
 
 class RebootRequired(nagiosplugin.Resource):
+    def __init__(self, scan=False, proc=PROC, maps_cache=MAPS_CACHE_FILE):
+        self.scan = scan
+        self.proc = proc
+        self.maps_cache = maps_cache
+
+    def scan_maps(self):
+        cache = read_maps_cache(self.maps_cache)
+        users = MapsScanner(self.proc, cache, time.time()).scan()
+        write_maps_cache(self.maps_cache, cache)
+        _log.info("%d units or processes use deleted files", len(users))
+        return nagiosplugin.Metric('restart', users)
+
     def probe(self):
-        with nagiosplugin.Cookie(COOKIE_FILE) as cookie:
+        metrics = self.probe_reboot()
+        if self.scan:
+            metrics.append(self.scan_maps())
+        return metrics
+
+    def probe_reboot(self):
+        with open_cookie(COOKIE_KEY, COOKIE_FILE) as cookie:
             if os.path.isfile("/run/reboot-required"):
                 _log.info("reboot-required file found")
 
@@ -79,8 +257,30 @@ class PackagesContext(nagiosplugin.Context):
         return nagiosplugin.Performance("packages", len(metric.value))
 
 
+class RestartContext(nagiosplugin.Context):
+    # Number of units (or processes outside of any) that use deleted files
+    def __init__(self, name, warning=None, critical=None):
+        super().__init__(name)
+        self.warning = nagiosplugin.Range(warning or "")
+        self.critical = nagiosplugin.Range(critical or "")
+
+    def evaluate(self, metric, resource):
+        count = len(metric.value)
+        hint = "{} services need a restart".format(count)
+        if not self.critical.match(count):
+            return nagiosplugin.Result(nagiosplugin.Critical, hint, metric)
+        if not self.warning.match(count):
+            return nagiosplugin.Result(nagiosplugin.Warn, hint, metric)
+        return nagiosplugin.Result(nagiosplugin.Ok, hint, metric)
+
+    def performance(self, metric, resource):
+        return nagiosplugin.Performance("restart", len(metric.value), None, self.warning, self.critical)
+
+
 class RebootRequiredSummary(nagiosplugin.Summary):
     def ok(self, results):
+        if "restart" in results and results["restart"].metric.value:
+            return "Not required, but {} services need a restart".format(len(results["restart"].metric.value))
         return "Not required"
 
     def problem(self, results):
@@ -88,18 +288,32 @@ class RebootRequiredSummary(nagiosplugin.Summary):
         delta = datetime.timedelta(seconds=results["age"].metric.value)
         delta = delta - datetime.timedelta(microseconds=delta.microseconds)
 
-        return "Required for {} packages since at least {}".format(
+        reboot = "Required for {} packages since at least {}".format(
             len(results["packages"].metric.value),
             delta
         )
+        if "restart" not in results or results["restart"].state == nagiosplugin.Ok:
+            return reboot
+        restart = results["restart"].hint
+        if results["age"].state == nagiosplugin.Ok and not results["age"].metric.value:
+            return restart
+        return "{}; {}".format(reboot, restart)
 
     def verbose(self, results):
+        lines = []
         if len(results["packages"].metric.value):
             package_list = map(
                 lambda name: "* {}".format(name),
                 sorted(results["packages"].metric.value)
             )
-            return ["Packages requiring update:"] + list(package_list)
+            lines += ["Packages requiring update:"] + list(package_list)
+        if "restart" in results and results["restart"].metric.value:
+            lines += ["Using deleted files:"] + [
+                "* {} (pid {})".format(unit, ", ".join(str(pid) for pid in sorted(pids)))
+                for (unit, pids) in sorted(results["restart"].metric.value.items())
+            ]
+        if lines:
+            return lines
 
 
 @nagiosplugin.guarded
@@ -110,13 +324,25 @@ def main():
     argp.add_argument('-c', '--critical', metavar='RANGE', default='604800',
                       help='return critical if reboot_required file age is outside RANGE')
     argp.add_argument('-v', '--verbose', action='count', default=0)
+    argp.add_argument('-s', '--scan', action='store_true',
+                      help='also look for processes using deleted libraries and executables')
+    argp.add_argument('--restart-warning', metavar='RANGE',
+                      help='return warning if the number of services needing a restart is outside RANGE')
+    argp.add_argument('--restart-critical', metavar='RANGE',
+                      help='return critical if the number of services needing a restart is outside RANGE')
+    argp.add_argument('--proc', metavar='DIR', default=PROC,
+                      help='proc file system to scan (default {}), e.g. a fake one for testing'.format(PROC))
+    argp.add_argument('--maps-cache', metavar='FILE', default=MAPS_CACHE_FILE,
+                      help='where to cache the maps of scanned processes (default {})'.format(MAPS_CACHE_FILE))
     args = argp.parse_args()
     check = nagiosplugin.Check(
-        RebootRequired(),
+        RebootRequired(args.scan, args.proc, args.maps_cache),
         nagiosplugin.ScalarContext('age', args.warning, args.critical),
         PackagesContext('packages'),
         RebootRequiredSummary()
     )
+    if args.scan:
+        check.add(RestartContext('restart', args.restart_warning, args.restart_critical))
     check.name = "REBOOT_REQUIRED"
     check.main(args.verbose)
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Client for check_server.py: runs a check in the server and exits with the check's output and exit code,
+# as if the check had been run directly. If the server is not running, the check is run directly.
+#
+# Usage: check_client.py <check> [check arguments]
+#    or: link to it with the check's name (e.g. check_nvidia, no .py) and call that with the check's arguments
+#
+# check_nvidia's --batch and --collect modes are refused by the server and have to be run directly.
+#
+# Kept to the few imports it needs, as its own start-up is still paid on every check. With Python 3.11, a
+# check_nvidia run from a snapshot took a median 96 ms directly and 53 ms through the server, of which 7.5 ms is
+# the request itself; the rest is this client: 18 ms for the interpreter and 16 ms for importing json and
+# socket. Only a client that is not written in Python would save that.
+
+import json
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.environ.get("CHECK_SERVER_SOCKET", "/run/check_server/check_server.sock")
+# Where the checks are, for running them without the server
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+# The server enforces the check timeouts; this is only for a server that stopped answering
+TIMEOUT = 300
+
+UNKNOWN = 3
+
+
+def run_directly(name, args):
+    script = os.path.join(PLUGIN_DIR, name + ".py")
+    os.execv(sys.executable, [sys.executable, script] + args)
+
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    if name.endswith(".py"):
+        name = name[:-3]
+    args = sys.argv[1:]
+    if name == "check_client":
+        if not args:
+            print("Usage: {} <check> [check arguments]".format(sys.argv[0]), file=sys.stderr)
+            sys.exit(UNKNOWN)
+        (name, args) = (args[0], args[1:])
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SOCKET_PATH)
+    except OSError:
+        run_directly(name, args)
+
+    try:
+        client.settimeout(TIMEOUT)
+        client.sendall(json.dumps({"check": name, "args": args}).encode("utf-8") + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        if not data:
+            raise ValueError("connection closed")
+        result = json.loads(data.decode("utf-8"))
+    except (OSError, ValueError) as e:
+        print("UNKNOWN: No result from check server: {}".format(e))
+        sys.exit(UNKNOWN)
+
+    sys.stdout.write(result["stdout"])
+    sys.stderr.write(result["stderr"])
+    sys.exit(result["status"])
+
+
+if __name__ == '__main__':
+    main()
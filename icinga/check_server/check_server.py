@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+#
+# Long-running server for the Python Icinga checks in this repository, so that a check run does not pay for
+# interpreter start-up and imports (nagiosplugin, argparse, ...) every time.
+#
+# The checks are imported once at start. Each request arrives on a Unix socket from check_client.py. It is run
+# in a child forked from the server, with the check's command line in sys.argv and its output captured. The
+# child runs in its own process group and is killed with everything it started once its check's timeout
+# expires, so a hung probe only ever costs its own client an UNKNOWN.
+#
+# Usage: check_server.py [--socket PATH] [--plugin-dir DIR] [--check NAME ...] [--timeout NAME=SECONDS ...]
+#
+# Only clients running as the server's own user or root are served, plus users given with --allow-user; run
+# it as the user the checks would run as otherwise (e.g. nagios), as clients choose the check arguments.
+# The client's environment and working directory are not passed on; checks get the server's.
+# SIGHUP re-executes the server once the running checks are done, e.g. to pick up upgraded checks.
+#
+# Requires Python 3 and the modules the served checks need
+
+"""Local server running preloaded Icinga checks"""
+
+import argparse
+import importlib.util
+import io
+import json
+import logging
+import os
+import pwd
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+
+SOCKET_PATH = "/run/check_server/check_server.sock"
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+CHECKS = ["check_nvidia", "check_reboot_required"]
+# Modes that are not a single check run: --collect samples forever, and --batch ends its child with os._exit,
+# which drops the captured result
+REFUSED_OPTIONS = {"check_nvidia": ["--batch", "--collect"]}
+# Seconds a check may run before it is killed, unless set per check with --timeout
+TIMEOUT = 30
+MAX_CHECKS = 16
+# Seconds a client has to send its request
+REQUEST_TIMEOUT = 5
+MAX_REQUEST = 64 * 1024
+
+UNKNOWN = 3
+
+_log = logging.getLogger("check_server")
+
+
+def load_checks(plugin_dir, names):
+    checks = {}
+    for name in names:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(plugin_dir, name + ".py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        checks[name] = module
+    return checks
+
+
+def unknown(message):
+    return {"status": UNKNOWN, "stdout": "UNKNOWN: {}\n".format(message), "stderr": ""}
+
+
+def parse_request(data, checks):
+    # Returns (check name, arguments), or raises ValueError with what is wrong for the client
+    request = json.loads(data.decode("utf-8"))
+    if not isinstance(request, dict):
+        raise ValueError("Malformed request")
+    name = request.get("check")
+    args = request.get("args", [])
+    if name not in checks:
+        raise ValueError("Check {} is not served".format(name))
+    if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+        raise ValueError("Malformed arguments")
+    for arg in args:
+        # Also abbreviated, as argparse accepts them
+        option = arg.split("=", 1)[0]
+        if len(option) > 2 and any(refused.startswith(option) for refused in REFUSED_OPTIONS.get(name, [])):
+            raise ValueError("{} is not served for {}, run it directly".format(option, name))
+    return (name, args)
+
+
+def run_check(module, name, args):
+    # In the forked child: run the check's main() as if it was started on its own
+    (stdout, stderr) = (io.StringIO(), io.StringIO())
+    (sys.stdout, sys.stderr) = (stdout, stderr)
+    sys.argv = [name] + args
+    try:
+        module.main()
+        status = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print(e.code, file=stderr)
+            status = 1
+    except BaseException:
+        traceback.print_exc(file=stderr)
+        status = UNKNOWN
+    return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+class Job(object):
+    def __init__(self, name, conn, pid, pipe, deadline):
+        self.name = name
+        self.conn = conn
+        self.pid = pid
+        self.pipe = pipe
+        self.deadline = deadline
+        self.started = time.monotonic()
+        self.chunks = []
+
+
+class CheckServer(object):
+    def __init__(self, checks, timeouts, max_checks, allowed_uids):
+        self.checks = checks
+        self.timeouts = timeouts
+        self.max_checks = max_checks
+        self.allowed_uids = allowed_uids
+        self.listener = None
+        # Connections still sending their request -> (data so far, deadline)
+        self.pending = {}
+        # Result pipe -> running check
+        self.jobs = {}
+        self.stopping = False
+        self.reloading = False
+
+    def listen(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(path):
+            os.remove(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Others are kept out by the credentials check rather than by the file mode if they can be allowed in
+        umask = os.umask(0o111 if self.allowed_uids - {0, os.getuid()} else 0o177)
+        try:
+            self.listener.bind(path)
+        finally:
+            os.umask(umask)
+        self.listener.listen(self.max_checks)
+        self.listener.setblocking(False)
+
+    def accept(self):
+        try:
+            (conn, _) = self.listener.accept()
+        except BlockingIOError:
+            return
+        (pid, uid, _) = struct.unpack("3i", conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                           struct.calcsize("3i")))
+        if uid not in self.allowed_uids:
+            _log.warning("Refused client pid %d running as uid %d", pid, uid)
+            conn.close()
+            return
+        conn.setblocking(False)
+        self.pending[conn] = (b"", time.monotonic() + REQUEST_TIMEOUT)
+
+    def receive(self, conn):
+        (data, deadline) = self.pending[conn]
+        try:
+            chunk = conn.recv(MAX_REQUEST)
+        except OSError:
+            chunk = b""
+        data += chunk
+        if b"\n" in data:
+            del self.pending[conn]
+            try:
+                (name, args) = parse_request(data.split(b"\n", 1)[0], self.checks)
+            except ValueError as e:
+                self.reply(conn, unknown(e))
+                return
+            self.start(name, args, conn)
+        elif not chunk or len(data) >= MAX_REQUEST:
+            del self.pending[conn]
+            conn.close()
+        else:
+            self.pending[conn] = (data, deadline)
+
+    def start(self, name, args, conn):
+        (read_fd, write_fd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            conn.close()
+            self.child(name, args, write_fd)
+        os.close(write_fd)
+        # Also here, so it is in place whenever the child is killed; fails if the child is already done
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        timeout = self.timeouts.get(name, TIMEOUT)
+        self.jobs[read_fd] = Job(name, conn, pid, read_fd, time.monotonic() + timeout)
+
+    def child(self, name, args, write_fd):
+        try:
+            # The server's signal handling, sockets and other checks' pipes are none of the check's business
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            os.setpgid(0, 0)
+            self.listener.close()
+            for conn in self.pending:
+                conn.close()
+            for job in self.jobs.values():
+                job.conn.close()
+                os.close(job.pipe)
+            result = run_check(self.checks[name], name, args)
+            data = json.dumps(result).encode("utf-8")
+            while data:
+                data = data[os.write(write_fd, data):]
+        finally:
+            os._exit(0)
+
+    def collect(self, pipe):
+        job = self.jobs[pipe]
+        chunk = os.read(pipe, 65536)
+        if chunk:
+            job.chunks.append(chunk)
+            return
+        self.finish(job)
+        (_, status) = os.waitpid(job.pid, 0)
+        try:
+            result = json.loads(b"".join(job.chunks).decode("utf-8"))
+        except ValueError:
+            result = unknown("{} exited without a result ({})".format(job.name, describe_status(status)))
+        _log.debug("%s finished in %.3fs with status %d", job.name, time.monotonic() - job.started,
+                   result["status"])
+        self.reply(job.conn, result)
+
+    def kill(self, job, message):
+        try:
+            os.killpg(job.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        os.waitpid(job.pid, 0)
+        self.finish(job)
+        self.reply(job.conn, unknown(message))
+
+    def finish(self, job):
+        del self.jobs[job.pipe]
+        os.close(job.pipe)
+
+    def reply(self, conn, result):
+        try:
+            conn.settimeout(REQUEST_TIMEOUT)
+            conn.sendall(json.dumps(result).encode("utf-8") + b"\n")
+        except OSError as e:
+            _log.info("Could not reply to client: %s", e)
+        conn.close()
+
+    def expire(self, now):
+        for (conn, (_, deadline)) in list(self.pending.items()):
+            if now >= deadline:
+                del self.pending[conn]
+                conn.close()
+        for job in list(self.jobs.values()):
+            if now >= job.deadline:
+                timeout = self.timeouts.get(job.name, TIMEOUT)
+                _log.warning("%s did not finish within %gs, killed", job.name, timeout)
+                self.kill(job, "Timeout: {} did not finish within {:g}s".format(job.name, timeout))
+
+    def serve(self):
+        while not self.stopping and not (self.reloading and not self.jobs):
+            readers = list(self.pending) + list(self.jobs)
+            if not self.reloading and len(self.pending) + len(self.jobs) < self.max_checks:
+                readers.append(self.listener)
+            deadlines = [deadline for (_, deadline) in self.pending.values()]
+            deadlines += [job.deadline for job in self.jobs.values()]
+            # Wake up at least every second to notice signals
+            wait = min([1.0] + [deadline - time.monotonic() for deadline in deadlines])
+            (readable, _, _) = select.select(readers, [], [], max(wait, 0))
+            for reader in readable:
+                if reader is self.listener:
+                    self.accept()
+                elif reader in self.pending:
+                    self.receive(reader)
+                elif reader in self.jobs:
+                    self.collect(reader)
+            self.expire(time.monotonic())
+
+        for job in list(self.jobs.values()):
+            self.kill(job, "Server stopped")
+        for conn in list(self.pending):
+            conn.close()
+        self.listener.close()
+
+
+def describe_status(status):
+    if os.WIFSIGNALED(status):
+        return "killed by signal {}".format(os.WTERMSIG(status))
+    return "status {}".format(os.WEXITSTATUS(status))
+
+
+def parse_timeout(value):
+    (name, _, seconds) = value.partition("=")
+    try:
+        return (name, float(seconds))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected NAME=SECONDS, got {!r}".format(value))
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument('--socket', default=SOCKET_PATH, help='Unix socket to listen on')
+    argp.add_argument('--plugin-dir', default=PLUGIN_DIR, help='directory holding the checks')
+    argp.add_argument('--check', action='append', metavar='NAME',
+                      help='check to serve, without .py; can be repeated (default: {})'.format(", ".join(CHECKS)))
+    argp.add_argument('--timeout', action='append', default=[], metavar='NAME=SECONDS', type=parse_timeout,
+                      help='timeout for a check (default: {}s); can be repeated'.format(TIMEOUT))
+    argp.add_argument('--max-checks', type=int, default=MAX_CHECKS, help='checks running at the same time')
+    argp.add_argument('--allow-user', action='append', default=[], metavar='USER',
+                      help='also serve clients running as this user; can be repeated')
+    argp.add_argument('-v', '--verbose', action='count', default=0, help='log every check run')
+    args = argp.parse_args()
+
+    # Not on the root logger, which would also get the checks' own logging
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    _log.addHandler(handler)
+    _log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    _log.propagate = False
+
+    names = args.check or CHECKS
+    try:
+        checks = load_checks(args.plugin_dir, names)
+        allowed_uids = {0, os.getuid()} | {pwd.getpwnam(user).pw_uid for user in args.allow_user}
+    except (ImportError, OSError, KeyError) as e:
+        _log.error("Cannot start: %s", e)
+        sys.exit(1)
+
+    server = CheckServer(checks, dict(args.timeout), args.max_checks, allowed_uids)
+
+    def stop(signum, frame):
+        server.stopping = True
+
+    def reload(signum, frame):
+        server.reloading = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    server.listen(args.socket)
+    _log.info("Serving %s on %s", ", ".join(names), args.socket)
+    server.serve()
+    os.remove(args.socket)
+
+    if server.reloading and not server.stopping:
+        _log.info("Reloading")
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# Shared state store for the Icinga checks in this repository, in place of a nagiosplugin.Cookie file per check.
+#
+# All state lives in one file, /var/lib/check_state/state (or $CHECK_STATE_FILE), as a log of JSON lines
+# [key, value]: the last line of a key holds its value. A commit that changes a cookie appends one line under a
+# lock, so a run that changes nothing writes nothing, and other checks' state is never rewritten. Once the log
+# has grown past COMPACT_SIZE and twice its live size, the commit compacts it to one line per key, written to a
+# new file that replaces the log atomically. A line cut short by a crash is ignored, and the next commit starts
+# on a line of its own. As every read replays the whole log, it is meant for small state: caches that are large
+# or change on every run belong in files of their own.
+#
+# Install next to the checks; they import it from there and fall back to their own cookie files without it, or
+# if the state directory is missing and cannot be created, or is not writable. The check_server.service unit
+# creates the directory; on hosts without it, create it for the Icinga user:
+#     install -d -o nagios -g nagios /var/lib/check_state
+#
+# Usage as a module: with check_state.Cookie("check_name") as cookie: ... (as with nagiosplugin.Cookie)
+# Usage as a script: check_state.py [--file FILE] [--compact] [KEY ...] to show (or compact) the state
+#
+# Requires Python 3
+
+"""Shared state store for Icinga checks"""
+
+import argparse
+import collections
+import fcntl
+import json
+import os
+import sys
+
+STATE_FILE = os.environ.get("CHECK_STATE_FILE", "/var/lib/check_state/state")
+# Bytes the log may grow to before it is compacted, if more than half of it is superseded
+COMPACT_SIZE = 256 * 1024
+
+
+def usable(path=STATE_FILE):
+    directory = os.path.dirname(path) or "."
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o755)
+        except OSError:
+            return False
+    return os.access(directory, os.W_OK | os.X_OK)
+
+
+def replay(data):
+    # {key: (value, line length)} of the last line of each key, without the cookies left empty
+    entries = {}
+    for line in data.split(b"\n")[:-1]:
+        try:
+            (key, value) = json.loads(line.decode("utf-8"))
+        except ValueError:
+            continue
+        entries[key] = (value, len(line) + 1)
+    return {key: entry for (key, entry) in entries.items() if entry[0]}
+
+
+def read_log(path):
+    try:
+        with open(path, "rb") as log:
+            return log.read()
+    except FileNotFoundError:
+        return b""
+
+
+def encode(key, value):
+    return json.dumps([key, value], separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class Lock(object):
+    # Exclusive lock for writing the log, on a file of its own, as compaction replaces the log file
+    def __init__(self, path):
+        self.path = path + ".lock"
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.file.close()
+        self.file = None
+
+
+def compact(path=STATE_FILE, force=False):
+    # With the lock held. Returns whether the log was rewritten.
+    data = read_log(path)
+    entries = replay(data)
+    live = sum(length for (_, length) in entries.values())
+    if not force and (len(data) < COMPACT_SIZE or len(data) < 2 * live):
+        return False
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as tmp:
+        tmp.writelines(encode(key, value) for (key, (value, _)) in sorted(entries.items()))
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    os.rename(tmp_path, path)
+    return True
+
+
+class Cookie(collections.UserDict):
+    # Drop-in for nagiosplugin.Cookie, keyed by name in the shared log instead of by file. Unlike it, the store
+    # is only locked while committing: concurrent runs of one check do not wait for each other, and the last
+    # commit wins.
+    def __init__(self, key, path=STATE_FILE):
+        super().__init__()
+        self.key = key
+        self.path = path
+        self.loaded = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not exc_type:
+            self.commit()
+        self.close()
+
+    def open(self):
+        (value, _) = replay(read_log(self.path)).get(self.key, ({}, 0))
+        if not isinstance(value, dict):
+            value = {}
+        self.data = value
+        # Compared with on commit, so that unchanged state is not written again
+        self.loaded = json.dumps(value, sort_keys=True)
+        return self
+
+    def commit(self):
+        if self.loaded is None:
+            raise IOError("cannot commit closed cookie", self.key)
+        current = json.dumps(self.data, sort_keys=True)
+        if current == self.loaded:
+            return
+        with Lock(self.path):
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                record = encode(self.key, self.data)
+                end = os.lseek(fd, 0, os.SEEK_END)
+                # After a torn write, so as not to be glued to (and dropped with) the partial line
+                if end and os.pread(fd, 1, end - 1) != b"\n":
+                    record = b"\n" + record
+                os.write(fd, record)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            compact(self.path)
+        self.loaded = current
+
+    def close(self):
+        self.loaded = None
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument('--file', default=STATE_FILE, help='state file')
+    argp.add_argument('--compact', action='store_true', help='compact the state file now')
+    argp.add_argument('key', nargs='*', help='keys to show (default: all)')
+    args = argp.parse_args()
+
+    if args.compact:
+        with Lock(args.file):
+            compact(args.file, force=True)
+    entries = replay(read_log(args.file))
+    for key in args.key or sorted(entries):
+        if key not in entries:
+            print("No state for {}".format(key), file=sys.stderr)
+            continue
+        print("{}: {}".format(key, json.dumps(entries[key][0], sort_keys=True)))
+
+
+if __name__ == '__main__':
+    main()
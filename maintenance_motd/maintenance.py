@@ -4,8 +4,8 @@
 # To be placed in /etc/update-motd.d/
 # Config file read from /etc/maintenance
 #
-# Requires Python 3.5+ due to PEP 484
-# Version 1.0
+# Runs on Python 3.4+; PEP 484 types are given as comments
+# Version 2.0
 #
 # Copyright (c) 2018 Alexander Kashev
 #
@@ -27,22 +27,94 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import configparser
-from datetime import datetime, timedelta
-from os import access, R_OK
-from os.path import isfile
+import os
 import sys
-from typing import Union
+import time
 
+MYPY = False
+if MYPY:
+    from typing import Callable, Iterator, List, Optional, Tuple, Union  # noqa: F401
 
-if len(sys.argv) > 1:
+
+CACHE_FILE = os.environ.get("MAINTENANCE_MOTD_CACHE", "/run/maintenance-motd.cache")
+
+args = sys.argv[1:]
+
+# Re-render the cache without printing, e.g. from a timer
+REFRESH = "--refresh" in args
+if REFRESH:
+    args.remove("--refresh")
+
+if len(args) > 0:
     # Debugging
-    CONFIG_FILE = sys.argv[1]
+    CONFIG_FILE = args[0]
 else:
     CONFIG_FILE = "/etc/maintenance.conf"
 
 
-def datetime2str(dt: datetime, date: bool=True) -> str:
+def input_stat(path):
+    # type: (str) -> Tuple[int, int]
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        # Missing inputs are recorded too, so that their appearance is noticed
+        return (-1, -1)
+
+
+# Cached banner, if it was rendered from the current config (and fleet slices) and is still up to date.
+# The header holds the expiry time and the number of input files, followed by one line per input.
+def read_cache(config_file):
+    # type: (str) -> Optional[str]
+    try:
+        with open(CACHE_FILE) as cache:
+            (expiry, count) = cache.readline().split()
+            if time.time() >= float(expiry):
+                return None
+            for index in range(int(count)):
+                (mtime, size, path) = cache.readline()[:-1].split(" ", 2)
+                if index == 0 and path != config_file:
+                    return None
+                if input_stat(path) != (int(mtime), int(size)):
+                    return None
+            return cache.read()
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+# Fast path for every login: a current cached banner (empty if nothing is scheduled)
+# needs neither configparser nor datetime
+if not REFRESH:
+    cached = read_cache(CONFIG_FILE)
+    if cached is not None:
+        sys.stdout.write(cached)
+        sys.exit(0)
+
+from bisect import bisect_right  # noqa: E402
+from collections import namedtuple  # noqa: E402
+import configparser  # noqa: E402
+from contextlib import redirect_stdout  # noqa: E402
+from datetime import date, datetime, timedelta  # noqa: E402
+import io  # noqa: E402
+from os import access, R_OK  # noqa: E402
+from os.path import isfile  # noqa: E402
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+ORDINALS = {"1st": 1, "2nd": 2, "3rd": 3, "4th": 4, "5th": 5, "last": -1}
+
+# Names of the fleet slices for hosts missing from the inventory, and prefix of tag slices
+ALL_HOSTS = "_all"
+TAG_PREFIX = "@"
+
+Window = namedtuple("Window", ["start", "end", "extra"])
+
+# One-off windows sorted by start, running maximum of their ends, and recurrence rules
+Schedule = namedtuple("Schedule", ["windows", "starts", "latest_ends", "rules"])
+
+
+def datetime2str(dt, date=True):
+    # type: (datetime, bool) -> str
     if date:
         return "{year:d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}".format(
             year=dt.year,
@@ -58,7 +130,8 @@ def datetime2str(dt: datetime, date: bool=True) -> str:
         )
 
 
-def print_upcoming(start: datetime, end: datetime, remaining: timedelta, extra: str, highlight: bool) -> None:
+def print_upcoming(start, end, remaining, extra, highlight):
+    # type: (datetime, datetime, timedelta, str, bool) -> None
     sequence = ""
 
     if highlight:
@@ -80,7 +153,8 @@ def print_upcoming(start: datetime, end: datetime, remaining: timedelta, extra:
         print("\n{}{}\033[0m\n".format(sequence, extra))
 
 
-def print_ongoing(start: datetime, end: datetime, extra: str) -> None:
+def print_ongoing(start, end, extra):
+    # type: (datetime, datetime, str) -> None
     start_string = datetime2str(start)
     end_string = datetime2str(end, date=(start.date() != end.date()))
 
@@ -92,7 +166,8 @@ def print_ongoing(start: datetime, end: datetime, extra: str) -> None:
         print("\n\033[31m{}\033[0m\n".format(extra))
 
 
-def estimate(interval: timedelta) -> str:
+def estimate(interval):
+    # type: (timedelta) -> str
     assert interval.total_seconds() >= 0
 
     days = interval.total_seconds() // (360 * 24) / 10  # type: float
@@ -100,7 +175,8 @@ def estimate(interval: timedelta) -> str:
     minutes = interval.total_seconds() // 6 / 10  # type: float
     seconds = interval.total_seconds()
 
-    def human_round(num: float) -> Union[int, float]:
+    def human_round(num):
+        # type: (float) -> Union[int, float]
         num = round(num * 2) / 2
 
         if num.is_integer() or num > 10:
@@ -108,7 +184,8 @@ def estimate(interval: timedelta) -> str:
         else:
             return num
 
-    def plural(num: float) -> str:
+    def plural(num):
+        # type: (float) -> str
         if human_round(num) == 1:
             return ""
         else:
@@ -124,36 +201,245 @@ def estimate(interval: timedelta) -> str:
         return "~{} second{}".format(seconds, plural(seconds))
 
 
-try:
+def write_cache(inputs, banner, valid_for):
+    # type: (List[Tuple[str, Tuple[int, int]]], str, float) -> None
+    try:
+        tmp_file = "{}.{}".format(CACHE_FILE, os.getpid())
+        with open(tmp_file, "w") as cache:
+            cache.write("{} {}\n".format(time.time() + valid_for, len(inputs)))
+            for (path, (mtime, size)) in inputs:
+                cache.write("{} {} {}\n".format(mtime, size, path))
+            cache.write(banner)
+        os.rename(tmp_file, CACHE_FILE)
+    except OSError:
+        # Not running as root; just don't cache
+        pass
+
+
+# Slices of the fleet-wide schedule that apply to this host, as written by maintenance_fleet.py:
+# its own (or the one for hosts missing from the inventory) and one per tag
+def fleet_slices(config):
+    # type: (configparser.ConfigParser) -> List[str]
+    fleet = config.get("config", "fleet", fallback=None)
+    if fleet is None:
+        return []
+    hostname = config.get("config", "hostname", fallback=os.uname().nodename)
+    tags = config.get("config", "tags", fallback="").replace(",", " ").split()
+
+    host_slice = os.path.join(fleet, hostname)
+    slices = [host_slice]
+    if not os.path.exists(host_slice):
+        slices.append(os.path.join(fleet, ALL_HOSTS))
+    slices.extend(os.path.join(fleet, TAG_PREFIX + tag) for tag in tags)
+    return slices
+
+
+def parse_time(text):
+    # type: (str) -> Tuple[int, int]
+    (hour, minute) = text.strip().split(":")
+    return (int(hour), int(minute))
+
+
+def nth_weekday(year, month, weekday, ordinal):
+    # type: (int, int, int, int) -> Optional[date]
+    if ordinal > 0:
+        first = date(year, month, 1)
+        day = first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (ordinal - 1))
+    else:
+        following = date(year + month // 12, month % 12 + 1, 1)
+        last = following - timedelta(days=1)
+        day = last - timedelta(days=(last.weekday() - weekday) % 7)
+    if day.month != month:
+        # No 5th such weekday this month
+        return None
+    return day
+
+
+def parse_rule(every, start_time, end_time, extra):
+    # type: (str, str, str, str) -> Callable[[datetime], Iterator[Window]]
+    # "every" is "<weekday>" (weekly) or "<1st|2nd|3rd|4th|5th|last> <weekday>" (monthly);
+    # returns a function yielding occurrences in order, from the first one that has not ended yet
+    words = every.lower().split()
+    if len(words) == 1:
+        ordinal = None
+    elif len(words) == 2 and words[0] in ORDINALS:
+        ordinal = ORDINALS[words[0]]
+    else:
+        raise ValueError("Cannot parse recurrence '{}'".format(every))
+    if words[-1] not in WEEKDAYS:
+        raise ValueError("Unknown weekday '{}'".format(words[-1]))
+    weekday = WEEKDAYS.index(words[-1])
+
+    (start_hour, start_minute) = parse_time(start_time)
+    (end_hour, end_minute) = parse_time(end_time)
+
+    def window(day):
+        # type: (date) -> Window
+        start = datetime(day.year, day.month, day.day, start_hour, start_minute)
+        end = datetime(day.year, day.month, day.day, end_hour, end_minute)
+        if end <= start:
+            # Crosses midnight
+            end += timedelta(days=1)
+        return Window(start, end, extra)
+
+    def occurrences(now):
+        # type: (datetime) -> Iterator[Window]
+        # Begin a day early to catch an occurrence that crosses midnight
+        since = (now - timedelta(days=1)).date()
+        if ordinal is None:
+            day = since + timedelta(days=(weekday - since.weekday()) % 7)
+            while True:
+                occurrence = window(day)
+                if occurrence.end >= now:
+                    yield occurrence
+                day += timedelta(days=7)
+        else:
+            (year, month) = (since.year, since.month)
+            while True:
+                day = nth_weekday(year, month, weekday, ordinal)
+                if day is not None:
+                    occurrence = window(day)
+                    if occurrence.end >= now:
+                        yield occurrence
+                (year, month) = (year + month // 12, month % 12 + 1)
+
+    return occurrences
+
+
+def read_schedule(config):
+    # type: (configparser.ConfigParser) -> Schedule
+    # Every [maintenance] or [maintenance <name>] section is a window: one-off with start / end,
+    # or recurring with every / from / to
+    windows = []  # type: List[Window]
+    rules = []  # type: List[Callable[[datetime], Iterator[Window]]]
+    for section in config.sections():
+        if section != "maintenance" and not section.startswith("maintenance "):
+            continue
+        extra = config.get(section, "extra", fallback="")
+        if config.has_option(section, "every"):
+            rules.append(parse_rule(
+                config.get(section, "every"), config.get(section, "from"), config.get(section, "to"), extra
+            ))
+        else:
+            start = datetime.strptime(config.get(section, "start"), "%Y-%m-%d %H:%M")
+            end = datetime.strptime(config.get(section, "end"), "%Y-%m-%d %H:%M")
+
+            # Sanity check
+            if start > end:
+                raise ValueError("Start time older than end time")
+
+            windows.append(Window(start, end, extra))
+
+    windows.sort()
+    latest_ends = []  # type: List[datetime]
+    for window in windows:
+        latest_ends.append(max(latest_ends[-1], window.end) if latest_ends else window.end)
+    return Schedule(windows, [window.start for window in windows], latest_ends, rules)
+
+
+# Window in progress (if any) and the next window to start
+def find_windows(schedule, now):
+    # type: (Schedule, datetime) -> Tuple[Optional[Window], Optional[Window]]
+    ongoing = None
+    upcoming = None
+
+    index = bisect_right(schedule.starts, now)
+    if index < len(schedule.windows):
+        upcoming = schedule.windows[index]
+    if index > 0 and schedule.latest_ends[index - 1] >= now:
+        # Some window that already started is still going; walk back to it
+        for window in reversed(schedule.windows[:index]):
+            if window.end >= now:
+                ongoing = window
+                break
+
+    for occurrences in schedule.rules:
+        for window in occurrences(now):
+            if window.start <= now:
+                ongoing = ongoing or window
+            else:
+                if upcoming is None or window.start < upcoming.start:
+                    upcoming = window
+                break
+
+    return (ongoing, upcoming)
+
+
+# Seconds until the rendered banner may change
+def valid_for(window, now, period, highlight_period):
+    # type: (Optional[Window], datetime, int, int) -> float
+    if window is None:
+        return float("inf")
+
+    remaining = (window.start - now).total_seconds()
+    deltas = [
+        remaining,
+        (window.end - now).total_seconds(),
+        remaining - period * 3600,
+        remaining - highlight_period * 3600,
+    ]
+
+    if 0 < remaining < period * 3600:
+        # estimate() only changes when the remaining time crosses a multiple of its granularity
+        if remaining >= 86400:
+            deltas.append(remaining % 8640)
+        elif remaining >= 3600:
+            deltas.append(remaining % 360)
+        elif remaining >= 60:
+            deltas.append(remaining % 6)
+        else:
+            return 0
+
+    future = [delta for delta in deltas if delta > 0]
+    if future:
+        return min(future)
+    else:
+        return float("inf")
+
+
+def render():
+    # type: () -> str
     config = configparser.ConfigParser()
     config.read(CONFIG_FILE)
 
     if not isfile(CONFIG_FILE) or not access(CONFIG_FILE, R_OK):
         raise ValueError("Config file not readable")
 
-    start = datetime.strptime(config.get("maintenance", "start"), "%Y-%m-%d %H:%M")
-    end = datetime.strptime(config.get("maintenance", "end"), "%Y-%m-%d %H:%M")
+    # Stat before reading, so that a change in between invalidates the cache rather than going unnoticed
+    slices = fleet_slices(config)
+    inputs = [(path, input_stat(path)) for path in [CONFIG_FILE] + slices]
+    # Sections repeated across slices (a window selected for the host and one of its tags) are merged
+    config.read(slices)
+
+    schedule = read_schedule(config)
     now = datetime.now()
-    remaining = start - now  # type: timedelta
 
-    extra = config.get("maintenance", "extra", fallback="")
     period = config.getint("config", "period")
     highlight_period = config.getint("config", "highlight_period", fallback=0)
 
-    # Sanity check
-    if start > end:
-        raise ValueError("Start time older than end time")
+    (ongoing, upcoming) = find_windows(schedule, now)
 
-    # No maintenance scheduled
-    if end < now:
-        exit()
+    banner = io.StringIO()
+    with redirect_stdout(banner):
+        if ongoing is not None:
+            print_ongoing(ongoing.start, ongoing.end, ongoing.extra)
+        elif upcoming is not None:
+            remaining = upcoming.start - now  # type: timedelta
+            if remaining < timedelta(hours=period):
+                highlight = remaining < timedelta(hours=highlight_period)
+                print_upcoming(upcoming.start, upcoming.end, remaining, upcoming.extra, highlight=highlight)
 
-    if start < now:
-        print_ongoing(start, end, extra)
-    elif remaining < timedelta(hours=period):
-        highlight = remaining < timedelta(hours=highlight_period)
-        print_upcoming(start, end, remaining, extra, highlight=highlight)
+    cache_for = valid_for(ongoing or upcoming, now, period, highlight_period)
+    if cache_for > 0:
+        write_cache(inputs, banner.getvalue(), cache_for)
+    return banner.getvalue()
+
+
+try:
+    banner = render()
+    if not REFRESH:
+        print(banner, end="")
 
-except ValueError as e:
-    print("Error reading maintenance configuration: " + e.args[0], file=sys.stderr)
+except (ValueError, configparser.Error) as e:
+    print("Error reading maintenance configuration: {}".format(e), file=sys.stderr)
     exit(1)
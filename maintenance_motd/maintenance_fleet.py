@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+# Resolves a fleet-wide maintenance schedule into per-host slices.
+#
+# The schedule lists the hosts (with the groups they belong to) and [maintenance <name>] windows as in
+# maintenance.conf, each optionally limited by "hosts" (hostname globs), "groups" or "tags". For every host
+# a slice holding only its windows is written to the output directory, plus one slice per tag and one for
+# hosts missing from the inventory; maintenance.py then reads just the few small files that apply to it.
+#
+# Usage: maintenance_fleet.py <fleet schedule> <slice directory>
+#
+# Runs on Python 3.4+
+
+import configparser
+import io
+import os
+import re
+import sys
+from fnmatch import translate
+
+MYPY = False
+if MYPY:
+    from typing import Dict, List, Set  # noqa: F401
+
+# Slice for hosts not in the inventory, and prefix of tag slices; neither can clash with a hostname
+ALL_HOSTS = "_all"
+TAG_PREFIX = "@"
+
+SELECTORS = ["hosts", "groups", "tags"]
+
+
+def split_list(value):
+    # type: (str) -> List[str]
+    return value.replace(",", " ").split()
+
+
+def read_fleet(path):
+    # type: (str) -> configparser.ConfigParser
+    # No interpolation: values are copied to the slices verbatim
+    fleet = configparser.ConfigParser(interpolation=None, allow_no_value=True)
+    # Hostnames are case sensitive
+    fleet.optionxform = str  # type: ignore
+    with open(path) as fleet_file:
+        fleet.read_file(fleet_file)
+    # Only [hosts] lists hosts without groups; anywhere else a key without a value is a mistake
+    for section in fleet.sections():
+        for (key, value) in fleet.items(section):
+            if value is None and section != "hosts":
+                raise configparser.Error("Key without a value in [{}]: {}".format(section, key))
+    return fleet
+
+
+def resolve(fleet):
+    # type: (configparser.ConfigParser) -> Dict[str, List[str]]
+    # Slice name -> names of the window sections it holds
+    inventory = fleet.options("hosts") if fleet.has_section("hosts") else []
+    members = {}  # type: Dict[str, Set[str]]
+    for host in inventory:
+        for group in split_list(fleet.get("hosts", host) or ""):
+            members.setdefault(group, set()).add(host)
+
+    slices = {host: [] for host in inventory}  # type: Dict[str, List[str]]
+    slices[ALL_HOSTS] = []
+    for section in fleet.sections():
+        if section == "maintenance":
+            # Would be merged into the [maintenance] window of every host's own maintenance.conf
+            raise configparser.Error("Unnamed [maintenance] window in the fleet schedule, use [maintenance <name>]")
+        if not section.startswith("maintenance "):
+            continue
+        selectors = {key: split_list(fleet.get(section, key, fallback="")) for key in SELECTORS}
+
+        if not any(selectors.values()):
+            for windows in slices.values():
+                windows.append(section)
+            continue
+
+        selected = set()  # type: Set[str]
+        if selectors["hosts"]:
+            pattern = re.compile("|".join(translate(glob) for glob in selectors["hosts"]))
+            selected.update(host for host in inventory if pattern.match(host))
+        for group in selectors["groups"]:
+            selected.update(members.get(group, ()))
+        for host in selected:
+            slices[host].append(section)
+        for tag in selectors["tags"]:
+            slices.setdefault(TAG_PREFIX + tag, []).append(section)
+    return slices
+
+
+def render_slice(fleet, sections):
+    # type: (configparser.ConfigParser, List[str]) -> str
+    out = configparser.ConfigParser(interpolation=None)
+    for section in sections:
+        out.add_section(section)
+        for (key, value) in fleet.items(section):
+            if key not in SELECTORS:
+                # Read back by maintenance.py with interpolation, where a lone % is an error
+                out.set(section, key, value.replace("%", "%%"))
+    text = io.StringIO()
+    out.write(text)
+    return text.getvalue()
+
+
+def write_slice(path, content):
+    # type: (str, str) -> bool
+    # Leave unchanged slices alone, so hosts keep their cached banners
+    try:
+        with open(path) as current:
+            if current.read() == content:
+                return False
+    except OSError:
+        pass
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as tmp:
+        tmp.write(content)
+    os.rename(tmp_path, path)
+    return True
+
+
+def main():
+    # type: () -> None
+    if len(sys.argv) != 3:
+        print("Usage: {} <fleet schedule> <slice directory>".format(sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
+    (fleet_path, slice_dir) = sys.argv[1:]
+
+    try:
+        fleet = read_fleet(fleet_path)
+        slices = resolve(fleet)
+    except (OSError, configparser.Error) as e:
+        print("Error reading fleet schedule: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+    if not os.path.isdir(slice_dir):
+        os.makedirs(slice_dir)
+    changed = 0
+    for (name, sections) in sorted(slices.items()):
+        if write_slice(os.path.join(slice_dir, name), render_slice(fleet, sections)):
+            changed += 1
+
+    # Hosts and tags that are gone; their hosts fall back to the _all slice
+    removed = 0
+    for name in os.listdir(slice_dir):
+        if name not in slices and not name.endswith(".tmp"):
+            os.remove(os.path.join(slice_dir, name))
+            removed += 1
+
+    print("{} slices, {} changed, {} removed".format(len(slices), changed, removed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+# Startup benchmark for the maintenance MOTD: runs the script repeatedly against a temporary config and cache,
+# cold (no cache, full render) and warm (cached banner), and summarises `python -X importtime` for both.
+#
+# Usage: startup_bench.py [--runs 50] [--script maintenance.py] [--baseline old-maintenance.py]
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+RUNS = 50
+# Import-time entries shown per scenario
+TOP_IMPORTS = 8
+
+CONFIG = """[config]
+period = 72
+highlight_period = 12
+
+[maintenance]
+start = {start}
+end = {end}
+extra = Benchmark window
+"""
+
+
+def write_config(path, hours_ahead):
+    start = datetime.now() + timedelta(hours=hours_ahead)
+    with open(path, "w") as config:
+        config.write(CONFIG.format(
+            start=start.strftime("%Y-%m-%d %H:%M"),
+            end=(start + timedelta(hours=2)).strftime("%Y-%m-%d %H:%M")
+        ))
+
+
+def run(script, config, env, extra_args=()):
+    start = time.monotonic()
+    subprocess.check_call([sys.executable] + list(extra_args) + [script, config], env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.monotonic() - start
+
+
+def import_times(script, config, env):
+    # Cumulative microseconds of the top-level imports, as reported by -X importtime
+    result = subprocess.run([sys.executable, "-X", "importtime", script, config], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        (_, cumulative, name) = line[len("import time:"):].split("|")
+        # Nested imports are indented further; only count the ones the script itself triggers
+        if not name[1:].startswith(" "):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)
+
+
+def scenarios(source, work, runs):
+    config = os.path.join(work, "maintenance.conf")
+    cache = os.path.join(work, "maintenance-motd.cache")
+    env = dict(os.environ, MAINTENANCE_MOTD_CACHE=cache)
+
+    # Older versions have the cache path hard-coded; never touch the real one
+    script = os.path.join(work, "maintenance.py")
+    with open(source) as original, open(script, "w") as copy:
+        copy.write(original.read().replace('"/run/maintenance-motd.cache"', repr(cache)))
+
+    def cold():
+        if os.path.exists(cache):
+            os.remove(cache)
+
+    def warm():
+        if not os.path.exists(cache):
+            run(script, config, env)
+
+    results = []
+    for (name, hours_ahead, prepare) in [
+        ("announced, cold", 24, cold),
+        ("announced, warm", 24, warm),
+        ("nothing scheduled, cold", 24 * 365, cold),
+        ("nothing scheduled, warm", 24 * 365, warm),
+    ]:
+        write_config(config, hours_ahead)
+        cold()
+        times = []
+        for _ in range(runs):
+            prepare()
+            times.append(run(script, config, env))
+        prepare()
+        results.append((name, sorted(times), import_times(script, config, env)))
+    cold()
+    return results
+
+
+def report(label, results, baseline=None):
+    print(label)
+    print("  {:<26} {:>9} {:>9} {:>9}{}".format("scenario", "min ms", "median ms", "max ms",
+                                                  "  vs baseline" if baseline else ""))
+    previous = {name: times for (name, times, _) in baseline or []}
+    for (name, times, _) in results:
+        median = times[len(times) // 2]
+        line = "  {:<26} {:>9.1f} {:>9.1f} {:>9.1f}".format(name, times[0] * 1000, median * 1000, times[-1] * 1000)
+        old = previous.get(name)
+        if old:
+            line += "  {:>+6.0%}".format(median / old[len(old) // 2] - 1)
+        print(line)
+
+    for (name, _, imports) in results:
+        print("  imports, {} (cumulative ms, total {:.1f}):".format(name, sum(us for (us, _) in imports) / 1000))
+        for (us, module) in imports[:TOP_IMPORTS]:
+            print("    {:>8.1f}  {}".format(us / 1000, module))
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Measure start-up time of the maintenance MOTD script")
+    argp.add_argument("--runs", type=int, default=RUNS, help="runs per scenario")
+    argp.add_argument("--script", default=os.path.join(HERE, "maintenance.py"), help="script to measure")
+    argp.add_argument("--baseline", metavar="SCRIPT", help="also measure an older version and compare")
+    args = argp.parse_args()
+
+    # Interpreter start-up alone, for reference
+    empty = [run("-c", "pass", os.environ) for _ in range(args.runs)]
+    print("python -c pass: median {:.1f} ms\n".format(sorted(empty)[len(empty) // 2] * 1000))
+
+    work = tempfile.mkdtemp(prefix="maintenance_motd_bench.")
+    try:
+        baseline = None
+        if args.baseline:
+            baseline = scenarios(args.baseline, work, args.runs)
+            report(args.baseline, baseline)
+            print()
+        report(args.script, scenarios(args.script, work, args.runs), baseline)
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,38 @@
 import os
+import time
+import errno
+import fcntl
+import filecmp
+import json
+import ctypes
+import select
+import mmap
+import shutil
+import hashlib
+import ctypes.util
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Non-system UID/GID range (Ubuntu-compatible)
+USER_ID_MIN = 1000
+USER_ID_MAX = 60000
+
+JOURNAL_KEEP = 10000
+
+FIELDS = {"passwd": 7, "shadow": 9, "group": 4, "gshadow": 4}
+DATABASES = ["passwd", "shadow", "group", "gshadow"]
+PAIRS = [("passwd", "shadow"), ("group", "gshadow")]
+KEYED = {"passwd": True, "shadow": False, "group": True, "gshadow": False}
+
+SNAPSHOT_MAGIC = "user_sync-snapshot"
+SNAPSHOT_VERSION = 1
+
+# Same lock files as shadow-utils (lckpwdf's .pwd.lock next to the database, and commonio),
+# so cppw, useradd etc. respect us and vice versa
+LOCK_TIMEOUT = 15
+
+# IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x80 | 0x100 | 0x200
 
 
 def get_id(line):
@@ -10,32 +44,669 @@ def get_name(line):
 
 
 def is_user(obj_id):
-    return (int(obj_id) >= 1000) and (int(obj_id) < 60000)
+    return (int(obj_id) >= USER_ID_MIN) and (int(obj_id) < USER_ID_MAX)
 
 
 def is_system(obj_id):
     return not is_user(obj_id)
 
 
+class Record(object):
+    # One database line, split once; id is the UID/GID field (None for shadow/gshadow)
+    __slots__ = ("name", "id", "line")
+
+    def __init__(self, line, keyed=True):
+        self.line = line.strip()
+        fields = self.line.split(":", 3)
+        self.name = fields[0]
+        self.id = fields[2] if keyed else None
+
+
+class Table(object):
+    # Records in file order, indexed by name and (for passwd/group) by id
+    __slots__ = ("records", "by_name", "by_id")
+
+    def __init__(self, records=()):
+        self.records = []
+        self.by_name = {}
+        self.by_id = {}
+        for record in records:
+            self.append(record)
+
+    def append(self, record):
+        self.records.append(record)
+        self.by_name.setdefault(record.name, record)
+        if record.id is not None:
+            self.by_id.setdefault(record.id, record)
+
+    def extend(self, table):
+        for record in table.records:
+            self.append(record)
+
+    def lines(self):
+        return [record.line for record in self.records]
+
+    def apply(self, changes, keyed=True):
+        return Table(apply_changes(self.records, changes, keyed))
+
+
+def apply_changes(records, changes, keyed=True):
+    # Replay (op, name, line) changes over a record stream: modified records stay in place, added ones go where
+    # a full merge puts them, i.e. before the record that follows them on the master ("add:<name>"), or last
+    updates = OrderedDict()
+    inserts = {}
+    for (op, name, line) in changes:
+        (op, _, successor) = op.partition(":")
+        updates[name] = None if op == "remove" else Record(line, keyed)
+        if op == "add" and successor:
+            inserts.setdefault(successor, []).append(name)
+    emitted = set()
+
+    def emit(name, record):
+        # Records added in front of this one first, which may have others added in front of them
+        for added in inserts.pop(name, []):
+            if added in updates:
+                emitted.add(added)
+                yield from emit(added, updates.pop(added))
+        if record is not None:
+            yield record
+
+    for record in records:
+        if record.name in updates:
+            emitted.add(record.name)
+            yield from emit(record.name, updates.pop(record.name))
+        elif record.name not in emitted:
+            yield from emit(record.name, record)
+    while updates:
+        yield from emit(*updates.popitem(last=False))
+
+
+def diff_tables(old, new):
+    changes = []
+    for record in old.records:
+        if record.name not in new.by_name:
+            changes.append(("remove", record.name, ""))
+    for (position, record) in enumerate(new.records, 1):
+        old_record = old.by_name.get(record.name)
+        if old_record is None:
+            # Nodes that predate positions read any op but "remove" as an append
+            successor = new.records[position].name if position < len(new.records) else None
+            changes.append(("add:" + successor if successor else "add", record.name, record.line))
+        elif old_record.line != record.line:
+            changes.append(("modify", record.name, record.line))
+    return changes
+
+
+def iter_table(db, keyed=True, criterion=(lambda x: True), names=None):
+    with open(db) as db_file:
+        for line in db_file:
+            record = Record(line, keyed)
+            if keyed:
+                if criterion(record.id):
+                    yield record
+            elif names is None or record.name in names:
+                yield record
+
+
+def read_table(db, keyed=True, criterion=(lambda x: True), names=None):
+    return Table(iter_table(db, keyed, criterion, names))
+
+
+def read_tables(db, shadow_db, criterion=(lambda x: True)):
+    table = read_table(db, criterion=criterion)
+    shadow_table = read_table(shadow_db, keyed=False, names=table.by_name)
+    return (table, shadow_table)
+
+
 def read_pair(db, shadow_db, criterion=(lambda x: True)):
-    with open(db) as passwd_file:
-        passwd = [line.strip() for line in passwd_file.readlines() if criterion(get_id(line))]
-        users = [get_name(line) for line in passwd]
-    with open(shadow_db) as shadow_file:
-        shadow = [line.strip() for line in shadow_file.readlines() if get_name(line) in users]
-    return (passwd, shadow)
+    (table, shadow_table) = read_tables(db, shadow_db, criterion)
+    return (table.lines(), shadow_table.lines())
+
+
+def merge(local_db, master_records, system_names):
+    # System records of a node followed by master records; collects the system names for merge_shadow
+    for record in iter_table(local_db, criterion=is_system):
+        system_names.add(record.name)
+        yield record.line
+    for record in master_records:
+        yield record.line
+
+
+def merge_shadow(local_shadow_db, master_records, system_names):
+    for record in iter_table(local_shadow_db, keyed=False, names=system_names):
+        yield record.line
+    for record in master_records:
+        yield record.line
+
+
+def nss_db_passwd(db):
+    # makedb input as generated by glibc's /var/db/Makefile: ".name" and "=uid" keys
+    for record in iter_table(db):
+        yield ".{} {}".format(record.name, record.line)
+        yield "={} {}".format(record.id, record.line)
+
+
+def nss_db_group(db):
+    # As above, plus ":member" keys listing the member's gids for initgroups
+    memberships = OrderedDict()
+    for record in iter_table(db):
+        yield ".{} {}".format(record.name, record.line)
+        yield "={} {}".format(record.id, record.line)
+        members = record.line.split(":", 3)[3]
+        if members:
+            for member in members.split(","):
+                memberships.setdefault(member, []).append(record.id)
+    for (member, gids) in memberships.items():
+        yield ":{} {} {}".format(member, member, ",".join(gids))
+
+
+def read_journal(name):
+    # Entries are "seq<TAB>db<TAB>op<TAB>name<TAB>line"; a partially written last line is ignored
+    entries = []
+    if not os.path.isfile(name):
+        return entries
+    with open(name) as journal:
+        for line in journal:
+            if not line.endswith("\n"):
+                break
+            (seq, db, op, obj_name, record) = line[:-1].split("\t", 4)
+            entries.append((int(seq), db, op, obj_name, record))
+    return entries
+
+
+def read_journal_since(name, after, block=1 << 16):
+    # (entries with a sequence above after, last sequence, whether the journal still reaches back to after + 1),
+    # read backwards from the end in blocks, so that the cost follows the number of new entries rather than the
+    # length of the journal; as read_journal, a partially written last line is ignored
+    if not os.path.isfile(name):
+        return ([], 0, True)
+    with open(name, "rb") as journal:
+        position = journal.seek(0, os.SEEK_END)
+        data = b""
+        while True:
+            start = max(0, position - block)
+            journal.seek(start)
+            data = journal.read(position - start) + data
+            position = start
+            # The first line may be cut off unless the file starts there
+            lines = data.split(b"\n")[(1 if position else 0):-1]
+            if not position or (lines and int(lines[0].split(b"\t", 1)[0]) <= after):
+                break
+
+    entries = []
+    for line in lines:
+        (seq, db, op, obj_name, record) = line.decode().split("\t", 4)
+        entries.append((int(seq), db, op, obj_name, record))
+    if not entries:
+        return ([], 0, True)
+    new_entries = [entry for entry in entries if entry[0] > after]
+    return (new_entries, entries[-1][0], entries[0][0] <= after + 1)
+
+
+def write_journal(name, db_changes):
+    entries = read_journal(name)
+    seq = entries[-1][0] if entries else 0
+
+    new_entries = []
+    for (db, changes) in db_changes:
+        for (op, obj_name, line) in changes:
+            seq += 1
+            new_entries.append((seq, db, op, obj_name, line))
+    if not new_entries:
+        return seq
+
+    # Compact once the journal doubles; nodes that fell behind fall back to a full snapshot
+    if len(entries) + len(new_entries) > 2 * JOURNAL_KEEP:
+        tmp_name = name + ".tmp"
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        entries = (entries + new_entries)[-JOURNAL_KEEP:]
+    else:
+        tmp_name = None
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        entries = new_entries
+
+    with open(os.open(tmp_name or name, flags, 0o600), "w") as journal:
+        journal.writelines("{}\t{}\t{}\t{}\t{}\n".format(*entry) for entry in entries)
+        journal.flush()
+        os.fsync(journal.fileno())
+    if tmp_name:
+        os.rename(tmp_name, name)
+    return seq
+
+
+def join_lines(lines):
+    first = True
+    for line in lines:
+        if first:
+            first = False
+            yield line
+        else:
+            yield "\n" + line
+
+
+def copy_prefix(source, target, count, block=1 << 16):
+    source.seek(0)
+    while count > 0:
+        data = source.read(min(count, block))
+        target.write(data)
+        count -= len(data)
 
 
 def write(name, lines):
-    data = "\n".join(lines)
-    if os.path.isfile(name):
-        with open(name) as old:
-            old_data = old.read()
-            if old_data == data:
+    # Streams "\n"-joined lines into name, comparing against the old content on the fly;
+    # an unchanged file is never rewritten, a changed one is replaced by rename
+    tmp_name = name + ".tmp"
+    old = open(name) if os.path.isfile(name) else None
+    out = None
+    matched = 0
+    try:
+        for chunk in join_lines(lines):
+            if out is None:
+                if old is not None and old.read(len(chunk)) == chunk:
+                    matched += len(chunk)
+                    continue
+                out = open(os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w")
+                if old is not None:
+                    copy_prefix(old, out, matched)
+            out.write(chunk)
+
+        if out is None:
+            if old is not None and old.read(1) == "":
                 return False
+            # Old file has trailing data or did not exist
+            out = open(os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w")
+            if old is not None:
+                copy_prefix(old, out, matched)
+
+        out.flush()
+        os.fsync(out.fileno())
+    finally:
+        if old is not None:
+            old.close()
+        if out is not None:
+            out.close()
+
+    os.rename(tmp_name, name)
+    return True
+
+
+def check_pair(db, shadow_db, fields, shadow_fields):
+    # In-process replacement for pwck/grpck: field counts, duplicate names and ids, passwd/shadow pairing
+    problems = []
+    names = set()
+    ids = set()
+    for record in iter_table(db):
+        if record.line.count(":") + 1 != fields:
+            problems.append("{}: invalid entry '{}'".format(db, record.line))
+        if record.name in names:
+            problems.append("{}: duplicate name '{}'".format(db, record.name))
+        if record.id in ids:
+            problems.append("{}: duplicate id {} for '{}'".format(db, record.id, record.name))
+        names.add(record.name)
+        ids.add(record.id)
 
-    old_umask = os.umask(0o77)
-    with open(name, "w") as out:
-        out.write("\n".join(lines))
-    os.umask(old_umask)
+    shadow_names = set()
+    for record in iter_table(shadow_db, keyed=False):
+        if record.line.count(":") + 1 != shadow_fields:
+            problems.append("{}: invalid entry '{}'".format(shadow_db, record.line))
+        if record.name in shadow_names:
+            problems.append("{}: duplicate name '{}'".format(shadow_db, record.name))
+        elif record.name not in names:
+            problems.append("{}: no matching entry in {} for '{}'".format(shadow_db, db, record.name))
+        shadow_names.add(record.name)
+
+    for name in names - shadow_names:
+        problems.append("{}: no matching entry in {} for '{}'".format(db, shadow_db, name))
+    return problems
+
+
+def check_databases(path):
+    problems = []
+    for (db, shadow_db) in PAIRS:
+        problems.extend(check_pair(path(db), path(shadow_db), FIELDS[db], FIELDS[shadow_db]))
+    return problems
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+@contextmanager
+def lock(target, timeout=LOCK_TIMEOUT):
+    # commonio convention: write our pid to target.<pid>, hard-link it to target.lock, break stale locks
+    lock_name = target + ".lock"
+    pid_name = "{}.{}".format(target, os.getpid())
+    with open(os.open(pid_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as pid_file:
+        pid_file.write(str(os.getpid()))
+
+    deadline = time.time() + timeout
+    try:
+        while True:
+            try:
+                os.link(pid_name, lock_name)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                with open(lock_name) as lock_file:
+                    owner = int(lock_file.read() or 0)
+                if not pid_alive(owner):
+                    os.remove(lock_name)
+                    continue
+            except (OSError, ValueError):
+                pass
+            if time.time() > deadline:
+                raise OSError(errno.EBUSY, "Cannot lock " + target)
+            time.sleep(0.1)
+    finally:
+        os.remove(pid_name)
+
+    try:
+        yield
+    finally:
+        os.remove(lock_name)
+
+
+@contextmanager
+def lock_pwd(pwd_lock_name, timeout=LOCK_TIMEOUT):
+    # lckpwdf equivalent
+    with open(os.open(pwd_lock_name, os.O_WRONLY | os.O_CREAT, 0o600)) as pwd_lock:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.lockf(pwd_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise OSError(errno.EBUSY, "Cannot lock " + pwd_lock_name)
+                time.sleep(0.1)
+        try:
+            yield
+        finally:
+            fcntl.lockf(pwd_lock, fcntl.LOCK_UN)
+
+
+def install(source, target):
+    # Atomic cppw/cpgr: copy to target+ with the target's owner and mode, fsync, rename under lock
+    tmp_name = target + "+"
+    stat = os.stat(target)
+    with lock_pwd(os.path.join(os.path.dirname(target), ".pwd.lock")), lock(target):
+        out = open(os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb")
+        with open(source, "rb") as src, out:
+            shutil.copyfileobj(src, out)
+            os.fchown(out.fileno(), stat.st_uid, stat.st_gid)
+            os.fchmod(out.fileno(), stat.st_mode & 0o7777)
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(tmp_name, target)
+
+
+def file_digest(name):
+    digest = hashlib.sha1()
+    with open(name, "rb") as data:
+        for block in iter(lambda: data.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprints(paths, previous=None):
+    # path -> [mtime_ns, size, inode, sha1] or None if missing; files with unchanged stat are not re-read
+    previous = previous or {}
+    result = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            result[path] = None
+            continue
+        stat = [st.st_mtime_ns, st.st_size, st.st_ino]
+        old = previous.get(path)
+        if old is not None and old[:3] == stat:
+            result[path] = old
+        else:
+            result[path] = stat + [file_digest(path)]
+    return result
+
+
+def same_content(current, previous):
+    return (
+        {path: fp and fp[3] for (path, fp) in current.items()} ==
+        {path: fp and fp[3] for (path, fp) in previous.items()}
+    )
+
+
+def read_fingerprints(name):
+    if not os.path.isfile(name):
+        return {}
+    with open(name) as fingerprint_file:
+        return json.load(fingerprint_file)
+
+
+def write_fingerprints(name, current):
+    write(name, [json.dumps(current, sort_keys=True)])
+
+
+class Watcher(object):
+    # Sleeps until something changes in one of the directories (via inotify) or the timeout expires
+    def __init__(self, directories):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        for directory in directories:
+            libc.inotify_add_watch(fd, directory.encode(), INOTIFY_MASK)
+        self.fd = fd
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if ready:
+            # Drain; callers re-check fingerprints rather than interpret events
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+def read_current(directory):
+    # Generation number the "current" pointer refers to, or None
+    try:
+        with open(os.path.join(directory, "current")) as current:
+            return int(current.read())
+    except (OSError, ValueError):
+        return None
+
+
+def generation_dir(directory, generation):
+    return os.path.join(directory, "generations", str(generation)) + "/"
+
+
+def publish_generation(directory, export, retention):
+    # export(path, generation) writes a complete export into a fresh directory, which becomes an immutable
+    # generation unless it is identical to the current one; the "current" pointer is then replaced by rename
+    current = read_current(directory)
+    generations_dir = os.path.join(directory, "generations")
+    if not os.path.isdir(generations_dir):
+        os.mkdir(generations_dir, 0o700)
+    existing = [int(name) for name in os.listdir(generations_dir) if name.isdigit()]
+    generation = max(existing + [current or 0]) + 1
+
+    new_dir = generation_dir(directory, generation)
+    tmp_dir = new_dir.rstrip("/") + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir, 0o700)
+    export(tmp_dir + "/", generation)
+
+    current_dir = generation_dir(directory, current) if current is not None else None
+    if current_dir is not None and os.path.isdir(current_dir):
+        names = sorted(os.listdir(tmp_dir))
+        if sorted(os.listdir(current_dir)) == names and all(
+            same_export(os.path.join(tmp_dir, name), os.path.join(current_dir, name)) for name in names
+        ):
+            shutil.rmtree(tmp_dir)
+            return (current, False)
+
+    os.rename(tmp_dir, new_dir)
+    write(os.path.join(directory, "current"), [str(generation)])
+    collect_generations(directory, generation, retention)
+    return (generation, True)
+
+
+def same_export(name, other):
+    # Snapshots carry their generation in the header, so they are compared by the digest of their content
+    header = read_snapshot_header(name)
+    if header is not None:
+        other_header = read_snapshot_header(other)
+        return other_header is not None and other_header["sha256"] == header["sha256"]
+    return filecmp.cmp(name, other, shallow=False)
+
+
+def collect_generations(directory, current, retention):
+    # A generation is removed once its successor has been published for longer than retention seconds,
+    # so that nodes still reading it can finish
+    generations_dir = os.path.join(directory, "generations")
+    generations = sorted(int(name) for name in os.listdir(generations_dir) if name.isdigit())
+    now = time.time()
+    for (generation, successor) in zip(generations, generations[1:]):
+        if generation == current:
+            continue
+        if os.path.getmtime(generation_dir(directory, successor)) < now - retention:
+            shutil.rmtree(generation_dir(directory, generation))
+
+
+# Snapshot layout: one header line
+#   "user_sync-snapshot <version> <generation> <sha256 of the rest> <index offset> <index length>
+#    passwd:<offset>:<length>:<sha256> shadow:... group:... gshadow:...\n"
+# followed by the four databases as in *.master files, then a JSON index {db: {name: [offset, length]}}.
+# Offsets are relative to the end of the header line.
+
+def write_snapshot(name, tables, generation=None):
+    # tables: db -> Table; unless given, the generation only increases when the content changes
+    body = []
+    sections = []
+    index = {}
+    offset = 0
+    for db in DATABASES:
+        records = {}
+        section = []
+        section_offset = offset
+        for record in tables[db].records:
+            data = record.line.encode()
+            if section:
+                section_offset += 1
+            records.setdefault(record.name, [section_offset, len(data)])
+            section.append(data)
+            section_offset += len(data)
+        data = b"\n".join(section)
+        sections.append("{}:{}:{}:{}".format(db, offset, len(data), hashlib.sha256(data).hexdigest()))
+        index[db] = records
+        body.append(data)
+        offset += len(data)
+
+    index_data = json.dumps(index, sort_keys=True).encode()
+    body.append(index_data)
+    digest = hashlib.sha256(b"".join(body)).hexdigest()
+
+    header = read_snapshot_header(name)
+    if header is not None and header["sha256"] == digest:
+        return False
+    if generation is None:
+        generation = header["generation"] + 1 if header is not None else 1
+
+    tmp_name = name + ".tmp"
+    with open(os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as out:
+        out.write("{} {} {} {} {} {} {}\n".format(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, generation, digest, offset, len(index_data), " ".join(sections)
+        ).encode())
+        out.writelines(body)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(tmp_name, name)
     return True
+
+
+def parse_snapshot_header(line):
+    fields = line.decode().split()
+    if len(fields) != 6 + len(DATABASES) or fields[0] != SNAPSHOT_MAGIC or int(fields[1]) != SNAPSHOT_VERSION:
+        return None
+    sections = {}
+    for field in fields[6:]:
+        (db, offset, length, digest) = field.split(":")
+        sections[db] = (int(offset), int(length), digest)
+    return {
+        "generation": int(fields[2]),
+        "sha256": fields[3],
+        "index": (int(fields[4]), int(fields[5])),
+        "sections": sections,
+    }
+
+
+def read_snapshot_header(name):
+    # Only reads the first line; None if missing or not a snapshot
+    try:
+        with open(name, "rb") as snapshot:
+            return parse_snapshot_header(snapshot.readline(4096))
+    except OSError:
+        return None
+
+
+class Snapshot(object):
+    def __init__(self, name):
+        with open(name, "rb") as snapshot:
+            self.data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        self.start = self.data.find(b"\n") + 1
+        header = parse_snapshot_header(self.data[:self.start])
+        if header is None:
+            raise ValueError(name + " is not a snapshot")
+        self.generation = header["generation"]
+        self.digest = header["sha256"]
+        self.sections = header["sections"]
+        (index_offset, index_length) = header["index"]
+        if self.start + index_offset + index_length != len(self.data):
+            raise ValueError(name + " is truncated")
+        self.index_range = (self.start + index_offset, len(self.data))
+        self.index = None
+
+    def verify(self):
+        digest = hashlib.sha256()
+        for offset in range(self.start, len(self.data), 1 << 20):
+            digest.update(self.data[offset:offset + (1 << 20)])
+        return digest.hexdigest() == self.digest
+
+    def records(self, db):
+        # Stream the records of one database straight from the mapping
+        keyed = KEYED[db]
+        (offset, length, digest) = self.sections[db]
+        position = self.start + offset
+        end = position + length
+        while position < end:
+            line_end = self.data.find(b"\n", position, end)
+            if line_end < 0:
+                line_end = end
+            yield Record(self.data[position:line_end].decode(), keyed)
+            position = line_end + 1
+
+    def lookup(self, db, obj_name):
+        if self.index is None:
+            self.index = json.loads(self.data[self.index_range[0]:self.index_range[1]].decode())
+        entry = self.index[db].get(obj_name)
+        if entry is None:
+            return None
+        (offset, length) = entry
+        return Record(self.data[self.start + offset:self.start + offset + length].decode(), KEYED[db])
+
+    def close(self):
+        self.data.close()
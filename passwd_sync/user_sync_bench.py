@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+#
+# Benchmark for user_sync: generates synthetic passwd / shadow / group / gshadow sets and times
+# read_pair, write and the master / node scripts against temporary directories.
+#
+# Usage: user_sync_bench.py [--sizes 1000,10000,100000,500000] [--output results.json] [--compare old.json]
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SIZES = [1000, 10000, 100000, 500000]
+SYSTEM_ACCOUNTS = 40
+# Synthetic accounts get ids from here up, beyond the default non-system range, which only holds 59000
+FIRST_ID = 100000
+MEMBERS_PER_SHARED_GROUP = 5000
+
+SALT_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789./"
+
+# Runs one phase in a child process and reports its /proc/self/io counters on exit
+PHASE = """
+import atexit, json, os, runpy, sys
+
+def report():
+    counters = {}
+    try:
+        with open("/proc/self/io") as io:
+            for line in io:
+                (key, value) = line.split(":")
+                counters[key] = int(value)
+    except OSError:
+        pass
+    with open(os.environ["USER_SYNC_BENCH_IO"], "w") as out:
+        json.dump(counters, out)
+
+atexit.register(report)
+sys.path.insert(0, os.environ["USER_SYNC_BENCH_HERE"])
+import user_sync
+user_sync.USER_ID_MIN = int(os.environ["USER_SYNC_BENCH_ID_MIN"])
+user_sync.USER_ID_MAX = int(os.environ["USER_SYNC_BENCH_ID_MAX"])
+if sys.argv[1] == "-c":
+    exec(sys.argv[2])
+else:
+    sys.argv = sys.argv[1:]
+    runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+READ_PAIR = """
+etc = os.environ["USER_SYNC_ETC"]
+user_sync.read_pair(etc + "passwd", etc + "shadow", user_sync.is_user)
+user_sync.read_pair(etc + "group", etc + "gshadow", user_sync.is_user)
+"""
+
+WRITE = """
+etc = os.environ["USER_SYNC_ETC"]
+(passwd, shadow) = user_sync.read_pair(etc + "passwd", etc + "shadow")
+user_sync.write(os.environ["USER_SYNC_DIR"] + "write.bench", passwd)
+"""
+
+
+def password_hash(rng):
+    return "$6${}${}".format(
+        "".join(rng.choice(SALT_CHARS) for _ in range(16)),
+        "".join(rng.choice(SALT_CHARS) for _ in range(86))
+    )
+
+
+def generate(etc, users, system_only=False, seed=0):
+    rng = random.Random(seed)
+    passwd = []
+    shadow = []
+    group = []
+    gshadow = []
+
+    for uid in range(SYSTEM_ACCOUNTS):
+        name = "sys{}".format(uid)
+        passwd.append("{0}:x:{1}:{1}:{0}:/var/lib/{0}:/usr/sbin/nologin".format(name, uid))
+        shadow.append("{}:*:17500:0:99999:7:::".format(name))
+        group.append("{}:x:{}:".format(name, uid))
+        gshadow.append("{}:*::".format(name))
+
+    if not system_only:
+        names = []
+        for index in range(users):
+            uid = FIRST_ID + index
+            name = "user{}".format(index)
+            names.append(name)
+            passwd.append("{0}:x:{1}:{1}:User {2},,,:/home/{0}:/bin/bash".format(name, uid, index))
+            shadow.append("{}:{}:{}:0:99999:7:::".format(name, password_hash(rng), rng.randint(15000, 19000)))
+            group.append("{}:x:{}:".format(name, uid))
+            gshadow.append("{}:!::".format(name))
+
+        # Shared groups with thousands of members each, above the personal group range
+        for index in range(max(1, users // 1000)):
+            gid = FIRST_ID + users + index
+            members = ",".join(rng.sample(names, min(len(names), MEMBERS_PER_SHARED_GROUP)))
+            group.append("project{}:x:{}:{}".format(index, gid, members))
+            gshadow.append("project{}:!::{}".format(index, members))
+
+    passwd.append("nobody:x:65534:65534:nobody:/nonexistent:/usr/sbin/nologin")
+    shadow.append("nobody:*:17500:0:99999:7:::")
+    group.append("nogroup:x:65534:")
+    gshadow.append("nogroup:*::")
+
+    os.makedirs(etc)
+    for (db, lines) in [("passwd", passwd), ("shadow", shadow), ("group", group), ("gshadow", gshadow)]:
+        with open(os.path.join(etc, db), "w") as out:
+            out.write("\n".join(lines) + "\n")
+
+
+def stub_tools(bin_dir):
+    os.makedirs(bin_dir)
+    for tool in ["pwck", "grpck", "cppw", "cpgr"]:
+        with open(os.path.join(bin_dir, tool), "w") as stub:
+            stub.write("#!/bin/sh\nexit 0\n")
+        os.chmod(os.path.join(bin_dir, tool), 0o755)
+
+
+def run_phase(args, env, io_file):
+    env = dict(env, USER_SYNC_BENCH_IO=io_file, USER_SYNC_BENCH_HERE=HERE)
+    with open(os.devnull, "w") as devnull:
+        start = time.monotonic()
+        process = subprocess.Popen([sys.executable, "-c", PHASE] + args, env=env, stdout=devnull)
+        # wait4 gives the rusage of this child alone
+        (_, status, usage) = os.wait4(process.pid, 0)
+        elapsed = time.monotonic() - start
+    process.returncode = status
+    if status:
+        raise RuntimeError("Phase {} failed with status {}".format(args, status))
+
+    with open(io_file) as io:
+        counters = json.load(io)
+    return {
+        "seconds": round(elapsed, 3),
+        "peak_rss_kib": usage.ru_maxrss,
+        "bytes_read": counters.get("rchar"),
+        "bytes_written": counters.get("wchar"),
+    }
+
+
+def bench(size, work):
+    master_etc = os.path.join(work, "master_etc") + "/"
+    node_etc = os.path.join(work, "node_etc") + "/"
+    shared = os.path.join(work, "shared") + "/"
+    bin_dir = os.path.join(work, "bin")
+
+    # Generate in a child: a forked phase would otherwise inherit our peak RSS into its ru_maxrss
+    generator = multiprocessing.Process(target=generate, args=(master_etc, size))
+    generator.start()
+    generator.join()
+    generate(node_etc, 0, system_only=True)
+    os.makedirs(shared)
+    stub_tools(bin_dir)
+
+    io_file = os.path.join(work, "io.json")
+    master_env = dict(
+        os.environ,
+        USER_SYNC_ETC=master_etc,
+        USER_SYNC_DIR=shared,
+        USER_SYNC_BENCH_ID_MIN=str(FIRST_ID),
+        USER_SYNC_BENCH_ID_MAX=str(FIRST_ID + size + size // 1000 + 1),
+    )
+    master_env["PATH"] = bin_dir + os.pathsep + master_env.get("PATH", "")
+    node_env = dict(master_env, USER_SYNC_ETC=node_etc)
+
+    phases = [
+        ("read_pair", ["-c", READ_PAIR], master_env),
+        ("write", ["-c", WRITE], master_env),
+        ("master", [os.path.join(HERE, "user_sync_master.py")], master_env),
+        ("master (unchanged)", [os.path.join(HERE, "user_sync_master.py")], master_env),
+        ("node", [os.path.join(HERE, "user_sync_node.py")], node_env),
+        ("node (unchanged)", [os.path.join(HERE, "user_sync_node.py")], node_env),
+    ]
+    return [dict(run_phase(args, env, io_file), phase=name) for (name, args, env) in phases]
+
+
+def report(results, baseline):
+    previous = {}
+    if baseline:
+        previous = {(entry["size"], entry["phase"]): entry for entry in baseline["results"]}
+
+    print("{:>8} {:<20} {:>9} {:>11} {:>13} {:>13}{}".format(
+        "accounts", "phase", "seconds", "peak KiB", "read", "written", "  vs baseline" if baseline else ""
+    ))
+    for entry in results:
+        line = "{:>8} {:<20} {:>9.3f} {:>11} {:>13} {:>13}".format(
+            entry["size"], entry["phase"], entry["seconds"], entry["peak_rss_kib"],
+            entry["bytes_read"], entry["bytes_written"]
+        )
+        old = previous.get((entry["size"], entry["phase"]))
+        if old and old["seconds"]:
+            line += "  {:>+6.0%} time, {:>+6.0%} memory".format(
+                entry["seconds"] / old["seconds"] - 1,
+                entry["peak_rss_kib"] / old["peak_rss_kib"] - 1
+            )
+        print(line)
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Benchmark user_sync on synthetic account databases")
+    argp.add_argument("--sizes", default=",".join(str(size) for size in SIZES),
+                      help="comma-separated numbers of accounts")
+    argp.add_argument("--output", metavar="FILE", help="save results as JSON")
+    argp.add_argument("--compare", metavar="FILE", help="compare with results saved by an earlier run")
+    args = argp.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        work = tempfile.mkdtemp(prefix="user_sync_bench.")
+        try:
+            results.extend(dict(entry, size=size) for entry in bench(size, work))
+        finally:
+            shutil.rmtree(work)
+
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump({"python": sys.version.split()[0], "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
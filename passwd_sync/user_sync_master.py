@@ -1,20 +1,87 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import user_sync
 
-DIR = "/home/configuration/user_sync/"
+DIR = os.environ.get("USER_SYNC_DIR", "/home/configuration/user_sync/")
+ETC = os.environ.get("USER_SYNC_ETC", "/etc/")
+JOURNAL = DIR + "changes.journal"
+# Last journal sequence the *.master files (and snapshots) reflect
+MASTER_SEQUENCE = DIR + "sequence.master"
 
-os.system("pwck -s")
-os.system("grpck -s")
+# Also export all four databases as a single checksummed, indexed snapshot file
+USE_SNAPSHOT = False
+SNAPSHOT = DIR + "users.snapshot"
 
-(passwd, shadow) = user_sync.read_pair("/etc/passwd", "/etc/shadow", user_sync.is_user)
-(group, gshadow) = user_sync.read_pair("/etc/group", "/etc/gshadow", user_sync.is_user)
+# Also publish each changed export as an immutable generations/<N>/ directory and point "current" at it;
+# superseded generations are removed RETENTION seconds after their successor appeared
+USE_GENERATIONS = False
+RETENTION = 3600
 
-changed = user_sync.write(DIR + "passwd.master", passwd)
-changed = user_sync.write(DIR + "shadow.master", shadow) or changed
-changed = user_sync.write(DIR + "group.master", group) or changed
-changed = user_sync.write(DIR + "gshadow.master", gshadow) or changed
+# Sort /etc databases with pwck/grpck before exporting
+USE_SHADOW_TOOLS = False
+
+
+def read_master(db, keyed, unexported):
+    # The *.master file with the journal entries a run that died before exporting them added on top
+    table = user_sync.Table()
+    if os.path.isfile(DIR + db + ".master"):
+        table = user_sync.read_table(DIR + db + ".master", keyed=keyed)
+    changes = [(op, name, line) for (seq, entry_db, op, name, line) in unexported if entry_db == db]
+    return table.apply(changes, keyed) if changes else table
+
+
+def read_number(name):
+    if not os.path.isfile(name):
+        return None
+    with open(name) as number_file:
+        return int(number_file.read())
+
+
+if USE_SHADOW_TOOLS:
+    os.system("pwck -s")
+    os.system("grpck -s")
+
+(passwd, shadow) = user_sync.read_tables(ETC + "passwd", ETC + "shadow", user_sync.is_user)
+(group, gshadow) = user_sync.read_tables(ETC + "group", ETC + "gshadow", user_sync.is_user)
+
+tables = [
+    ("passwd", passwd, True),
+    ("shadow", shadow, False),
+    ("group", group, True),
+    ("gshadow", gshadow, False),
+]
+# Diff against what the journal says, which is ahead of *.master if a run died between the two; without a stored
+# sequence (before it was kept), *.master is taken as up to date
+exported = read_number(MASTER_SEQUENCE)
+(unexported, _, complete) = user_sync.read_journal_since(JOURNAL, exported if exported is not None else sys.maxsize)
+if not complete:
+    unexported = []
+journal = [(db, user_sync.diff_tables(read_master(db, keyed, unexported), table)) for (db, table, keyed) in tables]
+
+# Journaled before the exports, so that no change is lost if this run dies in between: nodes replaying the journal
+# get it now, and full syncs only trust the exports up to MASTER_SEQUENCE
+sequence = user_sync.write_journal(JOURNAL, journal)
+
+changed = user_sync.write(DIR + "passwd.master", passwd.lines())
+changed = user_sync.write(DIR + "shadow.master", shadow.lines()) or changed
+changed = user_sync.write(DIR + "group.master", group.lines()) or changed
+changed = user_sync.write(DIR + "gshadow.master", gshadow.lines()) or changed
+if USE_SNAPSHOT:
+    changed = user_sync.write_snapshot(SNAPSHOT, {db: table for (db, table, keyed) in tables}) or changed
+
+if USE_GENERATIONS:
+    def export(path, generation):
+        for (db, table, keyed) in tables:
+            user_sync.write(path + db + ".master", table.lines())
+        if USE_SNAPSHOT:
+            user_sync.write_snapshot(path + "users.snapshot", {db: table for (db, table, keyed) in tables}, generation)
+
+    (generation, published) = user_sync.publish_generation(DIR, export, RETENTION)
+    changed = published or changed
+
+user_sync.write(MASTER_SEQUENCE, [str(sequence)])
 
 if changed:
     print("Changes applied")
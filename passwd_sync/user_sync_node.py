@@ -1,46 +1,258 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import time
 import socket
+import subprocess
+import shutil
 import filecmp
+import traceback
+from itertools import chain
 import user_sync
 
-DIR = "/home/configuration/user_sync/"
+DIR = os.environ.get("USER_SYNC_DIR", "/home/configuration/user_sync/")
+ETC = os.environ.get("USER_SYNC_ETC", "/etc/")
+JOURNAL = DIR + "changes.journal"
+MASTER_SEQUENCE = DIR + "sequence.master"
 
-os.system("pwck -s")
-os.system("grpck -s")
+# Replay only new entries of the master's change journal instead of rebuilding from *.master
+USE_JOURNAL = False
 
-(passwd, shadow) = user_sync.read_pair("/etc/passwd", "/etc/shadow", user_sync.is_system)
-(passwd_master, shadow_master) = user_sync.read_pair(DIR + "passwd.master", DIR + "shadow.master")
-passwd.extend(passwd_master)
-shadow.extend(shadow_master)
+# Read master records from the single-file snapshot instead of *.master;
+# the run is skipped if its generation was already applied
+USE_SNAPSHOT = False
+SNAPSHOT = DIR + "users.snapshot"
 
-(group, gshadow) = user_sync.read_pair("/etc/group", "/etc/gshadow", user_sync.is_system)
-(group_master, gshadow_master) = user_sync.read_pair(DIR + "group.master", DIR + "gshadow.master")
-group.extend(group_master)
-gshadow.extend(gshadow_master)
+# Read master records from the generation "current" points to, skipping the run if it was already applied
+USE_GENERATIONS = False
+
+# Sort, check and install with pwck/grpck/cppw/cpgr instead of the built-in validator and installer
+USE_SHADOW_TOOLS = False
+
+# Also build libnss-db lookup databases (by name, id and group member) with makedb
+NSS_DB = False
+NSS_DB_DIR = "/var/lib/misc/"
+
+# --watch: seconds between polls of the inputs, and quiet time before acting on a change
+POLL_INTERVAL = 60
+DEBOUNCE = 5
 
 node = socket.gethostname()
+SEQUENCE = DIR + "sequence." + node
+FINGERPRINTS = DIR + "fingerprints." + node
+GENERATION = DIR + "generation." + node
+PUBLISHED = DIR + "published." + node
+
+
+def read_number(name):
+    if not os.path.isfile(name):
+        return None
+    with open(name) as number_file:
+        return int(number_file.read())
+
+
+def master_records(db, master_dir, snapshot):
+    if snapshot is not None:
+        return snapshot.records(db)
+    return user_sync.iter_table(master_dir + db + ".master", keyed=user_sync.KEYED[db])
+
+
+def merge(db, shadow_db, master_dir=DIR, snapshot=None):
+    # Only names of local system accounts are held, to pair their shadow entries;
+    # master records are already paired by the master.
+    system_names = set()
+    user_sync.write(DIR + db + "." + node, user_sync.merge(
+        ETC + db, master_records(db, master_dir, snapshot), system_names
+    ))
+    user_sync.write(DIR + shadow_db + "." + node, user_sync.merge_shadow(
+        ETC + shadow_db, master_records(shadow_db, master_dir, snapshot), system_names
+    ))
+
+
+def replay(entries):
+    changes = {"passwd": [], "shadow": [], "group": [], "gshadow": []}
+    for (seq, db, op, name, line) in entries:
+        changes[db].append((op, name, line))
+
+    for (db, keyed) in [("passwd", True), ("shadow", False), ("group", True), ("gshadow", False)]:
+        records = user_sync.apply_changes(user_sync.iter_table(ETC + db, keyed=keyed), changes[db], keyed)
+        user_sync.write(DIR + db + "." + node, (record.line for record in records))
+
+
+def update_nss_db():
+    # Rebuilt only when the key list differs from the one the current .db was made from
+    if shutil.which("makedb") is None:
+        print("makedb not found, not updating " + NSS_DB_DIR, file=sys.stderr)
+        return
+    for (db, keys) in [("passwd", user_sync.nss_db_passwd), ("group", user_sync.nss_db_group)]:
+        source = DIR + db + ".nss." + node
+        target = NSS_DB_DIR + db + ".db"
+        # Trailing "" ends the last key line with a newline for makedb
+        if user_sync.write(source, chain(keys(ETC + db), [""])) or not os.path.isfile(target):
+            if subprocess.call(["makedb", "-o", target, source]) == 0:
+                os.chmod(target, 0o644)
+            else:
+                # Force a rebuild next time
+                os.remove(source)
+
+
+def sync():
+    if USE_SHADOW_TOOLS:
+        os.system("pwck -s")
+        os.system("grpck -s")
+
+    # Before any export is read: they reflect at least this journal sequence
+    exported = read_number(MASTER_SEQUENCE) if USE_JOURNAL else None
+
+    master_dir = DIR
+    published = None
+    if USE_GENERATIONS:
+        # The pointer alone tells whether there is anything new
+        published = user_sync.read_current(DIR)
+        if published is None:
+            print("No published generation in " + DIR, file=sys.stderr)
+            return False
+        if published == read_number(PUBLISHED):
+            print("No changes")
+            return True
+        master_dir = user_sync.generation_dir(DIR, published)
+
+    snapshot = None
+    if USE_SNAPSHOT:
+        # The header alone tells whether there is anything new
+        header = user_sync.read_snapshot_header(master_dir + "users.snapshot")
+        if header is None:
+            print("Cannot read " + master_dir + "users.snapshot", file=sys.stderr)
+            return False
+        if header["generation"] == read_number(GENERATION):
+            print("No changes")
+            return True
+
+        snapshot = user_sync.Snapshot(master_dir + "users.snapshot")
+        if not snapshot.verify():
+            print("Checksum mismatch in " + master_dir + "users.snapshot", file=sys.stderr)
+            return False
+
+    sequence = None
+    if USE_JOURNAL:
+        # Only the tail of the journal is read, back to the last applied entry (or, never synced, the last entry)
+        last_applied = read_number(SEQUENCE)
+        (entries, sequence, complete) = user_sync.read_journal_since(
+            JOURNAL, last_applied if last_applied is not None else sys.maxsize
+        )
+
+        if last_applied is not None and last_applied >= sequence:
+            print("No changes")
+            return True
+
+        if last_applied is None or not complete:
+            # Never synced or journal compacted past our position. The exports may lag behind the journal (the
+            # master journals first), so the entries after what they reflect are replayed on the next run.
+            merge("passwd", "shadow", master_dir, snapshot)
+            merge("group", "gshadow", master_dir, snapshot)
+            if exported is not None:
+                sequence = min(sequence, exported)
+        else:
+            replay(entries)
+    else:
+        merge("passwd", "shadow", master_dir, snapshot)
+        merge("group", "gshadow", master_dir, snapshot)
+
+    if USE_SHADOW_TOOLS:
+        os.system("pwck -s {} {}".format(DIR + "passwd." + node, DIR + "shadow." + node))
+        os.system("grpck -s {} {}".format(DIR + "group." + node, DIR + "gshadow." + node))
+    else:
+        problems = user_sync.check_databases(lambda db: DIR + db + "." + node)
+        if problems:
+            print("\n".join(problems), file=sys.stderr)
+            print("Not applying inconsistent databases", file=sys.stderr)
+            return False
+
+    changed = not filecmp.cmp(ETC + "passwd", DIR + "passwd." + node)
+    changed = not filecmp.cmp(ETC + "shadow", DIR + "shadow." + node) or changed
+    changed = not filecmp.cmp(ETC + "group", DIR + "group." + node) or changed
+    changed = not filecmp.cmp(ETC + "gshadow", DIR + "gshadow." + node) or changed
+
+    if changed and USE_SHADOW_TOOLS:
+        os.system("cppw " + DIR + "passwd." + node)
+        os.system("cppw -s " + DIR + "shadow." + node)
+        os.system("cpgr " + DIR + "group." + node)
+        os.system("cpgr -s " + DIR + "gshadow." + node)
+    elif changed:
+        for db in user_sync.DATABASES:
+            if not filecmp.cmp(ETC + db, DIR + db + "." + node):
+                user_sync.install(DIR + db + "." + node, ETC + db)
+
+    if changed:
+        print("Changes applied")
+    else:
+        print("No changes")
+
+    if NSS_DB:
+        update_nss_db()
+
+    if sequence is not None:
+        user_sync.write(SEQUENCE, [str(sequence)])
+    if snapshot is not None:
+        user_sync.write(GENERATION, [str(snapshot.generation)])
+        snapshot.close()
+    if published is not None:
+        user_sync.write(PUBLISHED, [str(published)])
+
+    return True
+
+
+def inputs():
+    paths = [ETC + db for db in user_sync.DATABASES]
+    if USE_GENERATIONS:
+        paths.append(DIR + "current")
+    elif USE_SNAPSHOT:
+        paths.append(SNAPSHOT)
+    else:
+        paths.extend(DIR + db + ".master" for db in user_sync.DATABASES)
+    if USE_JOURNAL:
+        paths.append(JOURNAL)
+    return paths
+
 
-user_sync.write(DIR + "passwd." + node, passwd)
-user_sync.write(DIR + "shadow." + node, shadow)
-user_sync.write(DIR + "group." + node, group)
-user_sync.write(DIR + "gshadow." + node, gshadow)
+def watch():
+    # Run sync only when an input changed since the last run, including runs before a restart.
+    # inotify just wakes us up early; polling catches changes it cannot see, e.g. over NFS.
+    paths = inputs()
+    watcher = user_sync.Watcher(sorted(set(os.path.dirname(path) for path in paths)))
+    cache = user_sync.read_fingerprints(FINGERPRINTS)
 
-os.system("pwck -s {} {}".format(DIR + "passwd." + node, DIR + "shadow." + node))
-os.system("grpck -s {} {}".format(DIR + "group." + node, DIR + "gshadow." + node))
+    while True:
+        current = user_sync.fingerprints(paths, cache)
+        if not user_sync.same_content(current, cache):
+            # Debounce: wait until the inputs stop changing
+            while True:
+                time.sleep(DEBOUNCE)
+                settled = user_sync.fingerprints(paths, current)
+                if user_sync.same_content(settled, current):
+                    break
+                current = settled
 
-changed = not filecmp.cmp("/etc/passwd", DIR + "passwd." + node)
-changed = not filecmp.cmp("/etc/shadow", DIR + "shadow." + node) or changed
-changed = not filecmp.cmp("/etc/group", DIR + "group." + node) or changed
-changed = not filecmp.cmp("/etc/gshadow", DIR + "gshadow." + node) or changed
+            try:
+                synced = sync()
+            except Exception:
+                # E.g. a lock timeout or a malformed line: log it and try again at the next poll
+                traceback.print_exc()
+                synced = False
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if synced:
+                current = user_sync.fingerprints(paths, current)
+                user_sync.write_fingerprints(FINGERPRINTS, current)
+            else:
+                # Keep the old fingerprints, so that the change that failed is retried
+                current = cache
+        cache = current
+        watcher.wait(POLL_INTERVAL)
 
-if changed:
-    os.system("cppw " + DIR + "passwd." + node)
-    os.system("cppw -s " + DIR + "shadow." + node)
-    os.system("cpgr " + DIR + "group." + node)
-    os.system("cpgr -s " + DIR + "gshadow." + node)
 
-    print("Changes applied")
-else:
-    print("No changes")
+if "--watch" in sys.argv[1:]:
+    watch()
+elif not sync():
+    exit(1)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import filecmp
+from concurrent.futures import ThreadPoolExecutor, wait
+import user_sync
+
+DIR = os.environ.get("USER_SYNC_DIR", "/home/configuration/user_sync/")
+
+# One target per line: "<hostname> <directory holding that node's passwd, shadow, group and gshadow>"
+NODES = DIR + "nodes"
+
+WORKERS = 16
+TIMEOUT = 60
+RETRIES = 2
+# Seconds before the first retry, doubled for each further one
+RETRY_DELAY = 2
+
+
+class DirectoryTransport(object):
+    # A node's databases reachable as plain files, e.g. an NFS export of its /etc or a staging directory.
+    # Other transports provide the same fetch / push pair.
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self, db, timeout):
+        # Local path of the node's current database
+        return os.path.join(self.path, db)
+
+    def push(self, source, db, timeout):
+        user_sync.install(source, os.path.join(self.path, db))
+
+
+def read_nodes():
+    nodes = []
+    with open(NODES) as nodes_file:
+        for (number, line) in enumerate(nodes_file, 1):
+            if not line.strip() or line[0] == "#":
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError("{}:{}: expected \"<hostname> <directory>\", got {!r}".format(
+                    NODES, number, line.strip()
+                ))
+            nodes.append((fields[0], DirectoryTransport(fields[1])))
+    return nodes
+
+
+def publish_once(name, transport, master, deadline):
+    def path(db):
+        return DIR + db + "." + name
+
+    def remaining():
+        left = deadline - time.time()
+        if left <= 0:
+            raise TimeoutError("timed out")
+        return left
+
+    for (db, shadow_db) in user_sync.PAIRS:
+        system_names = set()
+        user_sync.write(path(db), user_sync.merge(
+            transport.fetch(db, remaining()), master[db].records, system_names
+        ))
+        user_sync.write(path(shadow_db), user_sync.merge_shadow(
+            transport.fetch(shadow_db, remaining()), master[shadow_db].records, system_names
+        ))
+
+    problems = user_sync.check_databases(path)
+    if problems:
+        raise ValueError("; ".join(problems))
+
+    changed = []
+    for db in user_sync.DATABASES:
+        if not filecmp.cmp(transport.fetch(db, remaining()), path(db)):
+            transport.push(path(db), db, remaining())
+            changed.append(db)
+    return changed
+
+
+def publish(name, transport, master):
+    deadline = time.time() + TIMEOUT
+    delay = RETRY_DELAY
+    for attempt in range(RETRIES + 1):
+        try:
+            return (name, publish_once(name, transport, master, deadline), None)
+        except ValueError as e:
+            # The merged databases don't validate: a retry would get the same
+            return (name, None, e)
+        except Exception as e:
+            error = e
+        if time.time() + delay >= deadline:
+            break
+        time.sleep(delay)
+        delay *= 2
+    return (name, None, error)
+
+
+master = {}
+for (db, shadow_db) in user_sync.PAIRS:
+    (master[db], master[shadow_db]) = user_sync.read_tables(DIR + db + ".master", DIR + shadow_db + ".master")
+
+try:
+    nodes = read_nodes()
+except (OSError, ValueError) as e:
+    print(e, file=sys.stderr)
+    sys.exit(1)
+started = {}
+
+
+def run(index, name, transport):
+    started[index] = time.time()
+    return publish(name, transport, master)
+
+
+pool = ThreadPoolExecutor(max_workers=WORKERS)
+futures = [pool.submit(run, index, name, transport) for (index, (name, transport)) in enumerate(nodes)]
+
+# TIMEOUT is only checked between steps, and I/O on a hung mount can't be interrupted: give up on nodes that
+# have been running for longer than that, while queued ones still get their turn
+abandoned = set()
+pending = set(futures)
+while pending:
+    (_, pending) = wait(pending, timeout=1)
+    now = time.time()
+    for (index, future) in enumerate(futures):
+        if future in pending and now - started.get(index, now) > TIMEOUT + 1:
+            abandoned.add(future)
+    pending -= abandoned
+
+results = [
+    (name, None, TimeoutError("timed out")) if future in abandoned else future.result()
+    for ((name, _), future) in zip(nodes, futures)
+]
+
+failed = 0
+for (name, changed, error) in results:
+    if error is not None:
+        failed += 1
+        print("{}: FAILED: {}".format(name, error))
+    elif changed:
+        print("{}: changes applied to {}".format(name, ", ".join(changed)))
+    else:
+        print("{}: no changes".format(name))
+
+print("{} nodes, {} changed, {} failed".format(
+    len(results),
+    sum(1 for result in results if result[1]),
+    failed
+))
+
+sys.stdout.flush()
+if abandoned:
+    # Don't wait for the stuck workers at exit
+    os._exit(1)
+pool.shutdown()
+if failed:
+    sys.exit(1)